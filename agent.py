@@ -1,28 +1,267 @@
-from langchain_google_genai import ChatGoogleGenerativeAI
-from sentence_transformers import SentenceTransformer
+import operator
+import time
+_import_start = time.perf_counter()
+
 from langchain.tools import tool
 from langchain_core.messages import AIMessage, HumanMessage, ToolMessage, SystemMessage
 from langgraph.graph import StateGraph, END
 from langgraph.graph.message import add_messages
-from typing import TypedDict, Annotated, List
+from typing import TypedDict, Annotated, List, Optional
 from env import GEMINI_API_KEY
-from parse import parse_codebase, weights_for_query
+from parse import weights_for_query, exact_ranking, embed_text, in_pool_bootstrap
+from index import CodeIndex
+from tags import StaleIndexError
+from scanner import Scanner, DEFAULT_EXCLUDES, MAX_FILE_BYTES
+from embeddings import EmbeddingStore, EmbeddingService
+from ann import TagANN
+from lexical import LexicalIndex
+from depgraph import DependencyGraph
+from symbols import SymbolTable
+from reader import FileReader
+from context import ContextPacker, format_usage
+from tracing import tracer, token_usage
+from watcher import IndexWatcher
+from startup import Warmup
+from answer_cache import AnswerCache, contributing_files
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import os
-from memory import initialize_memory, get_memory_context, update_memory_node
+import threading
+from memory import initialize_memory, get_memory_context, BackgroundMemory, FindingStore
 from prompts import REFINE_QUERY_PROMPT
+from refine import RefineCache, classify_query
 from termcolor import colored
 
+warmup = Warmup()
+warmup.record("imports", time.perf_counter() - _import_start)
+
 if "GOOGLE_API_KEY" not in os.environ:
     os.environ["GOOGLE_API_KEY"] = GEMINI_API_KEY
 
-print(colored("[LOG] Loading embedding model...", 'green'))
-embed_model = SentenceTransformer("nomic-ai/nomic-embed-text-v1", trust_remote_code=True)
-print(colored("[LOG] Model loaded successfully.", 'green'))
+EMBED_MODEL_NAME = "nomic-ai/nomic-embed-text-v1"
+# cap on what one get_code_file_contents call returns (~4 bytes per token)
+FILE_READ_MAX_BYTES = int(os.environ.get("FILE_READ_MAX_BYTES", 24000))
+# long-term findings, persisted across sessions and recalled by relevance
+MEMORY_STORE = os.environ.get("MEMORY_STORE", "1") == "1"
+# token budget for the prompt call_model sends (system prompt, memory, messages)
+CONTEXT_BUDGET = int(os.environ.get("CONTEXT_BUDGET", 32000))
+# opt-in cache of final answers for repeated questions against an unchanged repo
+ANSWER_CACHE = os.environ.get("ANSWER_CACHE", "0") == "1"
+
+def load_code_index():
+    # SCAN_EXCLUDE adds comma-separated gitignore-style patterns to the defaults
+    extra_excludes = [p.strip() for p in os.environ.get("SCAN_EXCLUDE", "").split(",") if p.strip()]
+    scanner = Scanner(
+        os.getcwd(),
+        excludes=DEFAULT_EXCLUDES + tuple(extra_excludes),
+        max_file_bytes=int(os.environ.get("SCAN_MAX_FILE_BYTES", MAX_FILE_BYTES)),
+    )
+    code_index = CodeIndex.load(os.getcwd(), scanner=scanner)
+    code_index.refresh()
+    return code_index
+
+def load_llm():
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    llm = ChatGoogleGenerativeAI(
+        model="gemini-2.0-flash"
+    )
+    return llm, llm.bind_tools(tools)
+
+def load_embed_model():
+    from sentence_transformers import SentenceTransformer
+    model = SentenceTransformer(EMBED_MODEL_NAME, trust_remote_code=True)
+    # query embeddings from concurrent tool calls and sessions are batched together
+    return EmbeddingService(
+        model,
+        max_batch=int(os.environ.get("EMBED_MAX_BATCH", 32)),
+        max_wait=float(os.environ.get("EMBED_MAX_WAIT_MS", 5)) / 1000,
+    )
+
+def load_indexes():
+    # built from the code index alone, so find_symbol and symbol reads don't
+    # wait for (or depend on) the embedding model
+    code_index = get_code_index()
+    lexical_index = LexicalIndex()
+    lexical_index.sync(code_index)
+    dependency_graph = DependencyGraph.load(code_index)
+    symbol_table = SymbolTable()
+    symbol_table.sync(code_index, dependency_graph)
+    return lexical_index, dependency_graph, symbol_table
+
+def load_retrieval():
+    code_index = get_code_index()
+    # EMBED_QUANTIZATION=float16|int8 keeps a compact copy in RAM for scoring,
+    # rescoring the best EMBED_RESCORE candidates against the float32 vectors on disk
+    embedding_store = EmbeddingStore(
+        os.path.join(code_index.index_dir, 'embeddings'), EMBED_MODEL_NAME,
+        quantization=os.environ.get("EMBED_QUANTIZATION", "float32"),
+        rescore=int(os.environ.get("EMBED_RESCORE", 300)),
+    )
+    # exact search below ANN_EXACT_THRESHOLD tags; ANN_NPROBE trades recall for latency.
+    # vectors of edited tags are dropped once EMBED_COMPACT_RATIO of the live rows are unreferenced
+    tag_ann = TagANN(
+        embedding_store,
+        nprobe=int(os.environ.get("ANN_NPROBE", 8)),
+        exact_threshold=int(os.environ.get("ANN_EXACT_THRESHOLD", 20000)),
+        compact_ratio=float(os.environ.get("EMBED_COMPACT_RATIO", 0.5)),
+    )
+    tag_ann.sync(code_index, get_embed_model())
+    return embedding_store, tag_ann
+
+def sync_indexes(code_index, changes=None, generation=None):
+    with tracer.span('lexical_sync', 'index'):
+        get_lexical_index().sync(code_index)
+    with tracer.span('depgraph_sync', 'index'):
+        get_dependency_graph().sync(code_index, changes, generation)
+    with tracer.span('symbols_sync', 'index'):
+        get_symbol_table().sync(code_index, get_dependency_graph())
+
+def sync_ann(code_index):
+    with tracer.span('ann_sync', 'index'):
+        get_tag_ann().sync(code_index, get_embed_model())
+
+def sync_loaded_ann(code_index):
+    # while the embedding model loads (or if it can't), load_retrieval or the
+    # next get_relevant_code call syncs the ann instead
+    if warmup.loaded("retrieval"):
+        sync_ann(code_index)
+
+def load_answer_cache():
+    return AnswerCache(
+        get_code_index().index_dir,
+        EMBED_MODEL_NAME,
+        threshold=float(os.environ.get("ANSWER_CACHE_THRESHOLD", 0.95)),
+        max_size=int(os.environ.get("ANSWER_CACHE_SIZE", 256)),
+    )
+
+def load_memory_store():
+    return FindingStore(
+        get_code_index().index_dir,
+        lambda texts: get_embed_model().encode(texts, normalize_embeddings=True),
+        EMBED_MODEL_NAME,
+        max_findings=int(os.environ.get("MEMORY_MAX_FINDINGS", 1000)),
+    )
+
+def invalidate_answers(generation, changes):
+    changed = changes['modified'] + changes['removed'] + [old for old, _ in changes['renamed']]
+    get_answer_cache().invalidate(changed)
+
+def start_index_watcher():
+    code_index = get_code_index()
+    # keeps tags and embeddings current while the REPL runs
+    on_change = [
+        lambda generation, changes: sync_indexes(code_index, changes, generation),
+        lambda generation, changes: sync_loaded_ann(code_index),
+    ]
+    if ANSWER_CACHE:
+        on_change.append(invalidate_answers)
+    # WATCH_INOTIFY=0 forces polling; WATCH_INTERVAL is the poll period (and
+    # inotify wakeup), stretched with scan time up to WATCH_MAX_INTERVAL
+    index_watcher = IndexWatcher(
+        code_index, on_change=on_change,
+        interval=float(os.environ.get("WATCH_INTERVAL", 0.5)),
+        debounce=float(os.environ.get("WATCH_DEBOUNCE", 1.0)),
+        max_interval=float(os.environ.get("WATCH_MAX_INTERVAL", 30.0)),
+        use_inotify=os.environ.get("WATCH_INOTIFY", "1") == "1",
+    )
+    index_watcher.start()
+    return index_watcher
+
+def get_code_index():
+    return warmup.get("code_index")
+
+def get_llm():
+    return warmup.get("llm")[0]
+
+def get_llm_with_tools():
+    return warmup.get("llm")[1]
+
+def get_embed_model():
+    return warmup.get("embed_model")
+
+def get_embedding_store():
+    return warmup.get("retrieval")[0]
+
+def get_tag_ann():
+    return warmup.get("retrieval")[1]
+
+def get_lexical_index():
+    return warmup.get("indexes")[0]
+
+def get_dependency_graph():
+    return warmup.get("indexes")[1]
+
+def get_symbol_table():
+    return warmup.get("indexes")[2]
+
+def get_memory_store():
+    return warmup.get("memory_store") if MEMORY_STORE else None
+
+def get_recall_store():
+    # recall embeds the query, so until the model has loaded a turn uses the
+    # session's recent findings instead of waiting on warmup
+    if MEMORY_STORE and warmup.loaded("memory_store") and warmup.loaded("embed_model"):
+        return warmup.get("memory_store")
+    return None
+
+def get_answer_cache():
+    return warmup.get("answer_cache")
+
+def get_index_watcher():
+    if warmup.ready("index_watcher"):
+        return warmup.get("index_watcher")
+    return None
+
+def refresh_code_index():
+    code_index = get_code_index()
+    index_watcher = get_index_watcher()
+    if index_watcher is not None and index_watcher.is_alive():
+        # the watcher polls every interval; a query applies what it has
+        # already seen instead of walking the tree on the query thread
+        index_watcher.flush()
+    else:
+        generation, changes = code_index.refresh()
+        if any(changes.values()) and warmup.loaded("indexes"):
+            sync_indexes(code_index, changes, generation)
+    return code_index
+
+STALE_RETRIES = 3
 
 def find_relevant_files(query: str) -> str:
     try:
-        all_tags, _ = parse_codebase(os.getcwd())
-        ranked_files, ranked_tags = weights_for_query(query, all_tags, embed_model)
+        code_index = refresh_code_index()
+        dependency_graph = get_dependency_graph()
+        # the watcher can refresh the index between the sync and the search;
+        # positions from the lexical index and ann are only valid for the
+        # generation they were synced to, so retry on a newer one
+        for attempt in range(STALE_RETRIES):
+            sync_indexes(code_index)
+            generation, all_tags = code_index.tag_snapshot()
+            try:
+                # a query naming an identifier is answered from the lexical
+                # index without waiting for the embedding model or the ann
+                ranked = exact_ranking(query, all_tags, get_lexical_index(), dependency_graph, generation=generation)
+                if ranked is None:
+                    sync_ann(code_index)
+                    with tracer.span('weights_for_query', 'index', tags=len(all_tags)):
+                        ranked = weights_for_query(
+                            query, all_tags, get_embed_model(),
+                            store=get_embedding_store(), ann=get_tag_ann(), lexical=get_lexical_index(),
+                            graph=dependency_graph, generation=generation,
+                        )
+                ranked_files, ranked_tags = ranked
+                break
+            except StaleIndexError:
+                if attempt == STALE_RETRIES - 1:
+                    raise
+
+        # callers and callees of the best match, so the agent doesn't need
+        # another round trip to find them
+        related_files = "None"
+        if ranked_files:
+            best = ranked_files[0][0]
+            callers = sorted(dependency_graph.callers(best))
+            callees = sorted(dependency_graph.callees(best))
+            related_files = f"{best} is used by: {', '.join(callers) or 'nothing'}\n{best} uses: {', '.join(callees) or 'nothing'}"
         
         if ranked_files:
             ranked_files_str = []
@@ -32,22 +271,17 @@ def find_relevant_files(query: str) -> str:
         else:
             ranked_files = "No relevant files found"
             
+        # one block per tag, best first, with a '--- path:start-end name' header
+        # the context packer uses to dedupe and trim them
         if ranked_tags:
             ranked_tags_str = []
-            for item in ranked_tags:
-                if isinstance(item, tuple):
-                    ranked_tags_str.append(str(item[0]) if item else "")
-                else:
-                    ranked_tags_str.append(str(item))
-            ranked_tags = '\n'.join(ranked_tags_str)
+            for name, (score, text, (file_path, start_line, end_line)) in ranked_tags:
+                ranked_tags_str.append(f"--- {file_path}:{start_line}-{end_line} {name}\n{text}\n")
+            ranked_tags = ''.join(ranked_tags_str)
         else:
             ranked_tags = "No relevant tags found"
-            
-        response = {
-            "ranked_files": ranked_files,
-            "ranked_tags": ranked_tags
-        }
-        return str(response)
+
+        return f"Ranked files:\n{ranked_files}\n\nRelated files:\n{related_files}\n\nRanked tags:\n{ranked_tags}"
     except Exception as e:
         print(colored(f"[ERROR] Exception in find_relevant_files: {e}", 'green'))
         return f"Error occurred while finding relevant files: {e}"
@@ -66,8 +300,13 @@ def list_files(path: str) -> str:
         if not os.path.exists(path):
             return f"Error: Directory '{path}' does not exist"
             
-        files = [f for f in os.listdir(path) if os.path.isfile(os.path.join(path, f))]
-        dirs = [d for d in os.listdir(path) if os.path.isdir(os.path.join(path, d))]
+        files, dirs = [], []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    dirs.append(entry.name)
+                elif entry.is_file():
+                    files.append(entry.name)
         
         result = []
         if dirs:
@@ -81,15 +320,22 @@ def list_files(path: str) -> str:
     except Exception as e:
         return f"Error occurred: {e}"
 
-def read_code_file(file_path: str) -> str:
+file_reader = FileReader(max_bytes=FILE_READ_MAX_BYTES)
+
+def read_code_file(file_path: str, start_line: int = None, end_line: int = None, symbol: str = None) -> str:
     try:
         if not os.path.exists(file_path):
             return f"Error: File Not Found"
         if not os.path.isfile(file_path):
             return f"Error: {file_path} is not a file"
-        with open(file_path, 'r', encoding='UTF-8') as f:
-            content = f.read()
-        return content
+        if symbol:
+            # no-op unless the index changed without the watcher syncing it
+            sync_indexes(refresh_code_index())
+            found = get_symbol_table().definition_range(symbol, os.path.abspath(file_path))
+            if found is None or found[0] != os.path.abspath(file_path):
+                return f"Error: '{symbol}' is not defined in {file_path}"
+            _, start_line, end_line = found
+        return file_reader.read(file_path, start_line, end_line)
     except Exception as e:
         return f"Error occurred: {e}"
 
@@ -106,15 +352,20 @@ def get_directory_contents(dir_path: str) -> str:
     return list_files(dir_path)
 
 @tool("get_code_file_contents")
-def get_code_file_contents(file_name: str) -> str:
+def get_code_file_contents(file_name: str, start_line: Optional[int] = None, end_line: Optional[int] = None, symbol: Optional[str] = None) -> str:
     """
     Reads the contents of a given file. Use this tool when the user asks you questions
     based on the contents of a given filename or implies a need to load a file given 
     the filename. 
     The 'file_name' parameter should be the name of the file with an absolute 
     file path (eg. 'test_code/my_script.py')
+    To read only part of a file, pass 'start_line' and/or 'end_line' (1-based,
+    inclusive), or 'symbol' with the name of a function or class defined in it
+    (eg. 'get_user' or 'Database.get_user') to read just that definition.
+    Large reads are cut off with a "[truncated, request lines X-Y]" marker;
+    request those lines in another call if you need them.
     """
-    return read_code_file(file_name)
+    return read_code_file(file_name, start_line, end_line, symbol)
 
 @tool("get_relevant_code")
 def get_relevant_code(query: str) -> str:
@@ -127,18 +378,47 @@ def get_relevant_code(query: str) -> str:
     """
     return find_relevant_files(query)
 
-tools = [get_code_file_contents, get_directory_contents, get_relevant_code]
+@tool("find_symbol")
+def find_symbol(name: str) -> str:
+    """
+    Finds where a function, class or variable is defined and every place it is
+    called or imported from. Use this when the user asks where something is
+    defined, who calls it, or what uses it.
+    The 'name' parameter can be a bare name ('get_stock_price'), a method
+    ('Database.get_user') or a dotted module path ('services.market_data.get_stock_price').
+    """
+    try:
+        # no-op unless the index changed without the watcher syncing it
+        sync_indexes(refresh_code_index())
+        return get_symbol_table().describe(name)
+    except Exception as e:
+        return f"Error occurred: {e}"
+
+tools = [get_code_file_contents, get_directory_contents, get_relevant_code, find_symbol]
 
 tool_map = {tool.name:tool for tool in tools}   
 
-llm = ChatGoogleGenerativeAI(
-    model="gemini-2.0-flash"
-)
-llm_with_tools = llm.bind_tools(tools)
+# parse workers re-import the main module (this file, or server.py importing
+# it); they must not start loading the index and models themselves
+if not in_pool_bootstrap():
+    warmup.submit("code_index", load_code_index)
+    # only reads memory.json next to the index; embeds lazily through the model
+    if MEMORY_STORE:
+        warmup.submit("memory_store", load_memory_store)
+    warmup.submit("indexes", load_indexes)
+    warmup.submit("llm", load_llm)
+    warmup.submit("embed_model", load_embed_model)
+    warmup.submit("retrieval", load_retrieval)
+    if ANSWER_CACHE:
+        warmup.submit("answer_cache", load_answer_cache)
 
 class AgentState(TypedDict):
     messages: Annotated[List[HumanMessage | AIMessage | ToolMessage], add_messages]
     memory: dict
+    # server session whose long-term findings are recalled; None in the REPL
+    session: Optional[str]
+    # token usage of each model call this turn; starts empty per invoke
+    usage: Annotated[list, operator.add]
 
 from langchain_core.prompts import ChatPromptTemplate
 
@@ -148,8 +428,9 @@ prompt_template = ChatPromptTemplate.from_messages([
 ## Your Capabilities:
 You have access to the following tools:
 1.  **get_directory_contents**: To list files and folders in a specific directory.
-2.  **get_code_file_contents**: To read the full content of a specific file.
+2.  **get_code_file_contents**: To read a specific file, or just a line range or one function/class of it.
 3.  **get_relevant_code**: To perform a semantic search for code snippets and files related to a concept or question.
+4.  **find_symbol**: To look up where a named function, class or variable is defined and everywhere it is called or imported.
 
 ## Core Directives & Strategy:
 Your primary task is to choose the correct tool for the job. Follow these heuristics:
@@ -162,12 +443,18 @@ Your primary task is to choose the correct tool for the job. Follow these heuris
 2.  **For Reading Specific Files (`get_code_file_contents`)**:
     * When the user provides a **specific and complete file path** (e.g., "Read `src/utils/parser.py`", "What's in `README.md`?").
     * Do **NOT** use this tool if the user is asking a conceptual question. It is for retrieving the literal content of a known file.
+    * When you only need one function or class (e.g. after `find_symbol` or `get_relevant_code` told you where it is), pass `symbol` or a line range instead of reading the whole file.
 
 3.  **For Conceptual Questions & Code Search (`get_relevant_code`)**:
     * This is your most powerful tool. Use it when the user asks **how something works**, **where something is defined**, or any **high-level/conceptual question**.
     * **Examples**: "How is user authentication handled?", "Find the database connection logic", "Where are the API endpoints defined?".
     * The query you pass to this tool should be a clear, self-contained question.
 
+4.  **For Definitions & Usages of a Named Symbol (`find_symbol`)**:
+    * When the user names a specific function, class or variable and asks where it is defined, who calls it, or what would be affected by changing it.
+    * **Examples**: "Where is `get_stock_price` defined?", "What calls `Database.get_user`?".
+    * Prefer this over `get_relevant_code` when the exact name is known; it is an exact lookup, not a search.
+
 ## Memory Usage:
 You have a memory of previous messages and key findings.
 * **memory_context**: 
@@ -184,64 +471,159 @@ Begin!"""),
     ("placeholder", "{messages}")
 ])
 
-def wrapped_update_memory_node(state):
-    return update_memory_node(state, llm)
+context_packer = ContextPacker(budget=CONTEXT_BUDGET)
+
+def current_query(messages):
+    """
+    The refined query of this turn if refine_query produced one, otherwise
+    the user's last message.
+    """
+    for i in range(len(messages) - 1, -1, -1):
+        if isinstance(messages[i], HumanMessage):
+            following = messages[i + 1] if i + 1 < len(messages) else None
+            if isinstance(following, AIMessage) and not following.tool_calls and following.content:
+                return str(following.content)
+            return str(messages[i].content)
+    return None
 
 def call_model(state):
     messages = state["messages"]
     memory = state.get('memory', initialize_memory().copy())
-    memory_context = get_memory_context(memory)
-    
+    memory_context = get_memory_context(memory, store=get_recall_store(), query=current_query(messages),
+                                        session=state.get('session'))
+
+    system_prompt = prompt_template.format_messages(messages=[], memory_context='')[0].content
+    memory_context, messages, usage = context_packer.pack(system_prompt, memory_context, messages)
+    print(colored(f"[LOG] {format_usage(usage)}", 'green'))
+
     formatted_messages = prompt_template.format_messages(messages=messages, memory_context=memory_context)
     
-    response = llm_with_tools.invoke(formatted_messages)
-    return {"messages": [response]}
+    with tracer.span('agent', 'llm') as span:
+        response = get_llm_with_tools().invoke(formatted_messages)
+        prompt_tokens, response_tokens = token_usage(response, usage['total'])
+        span.set(prompt_tokens=prompt_tokens, response_tokens=response_tokens, tool_calls=len(response.tool_calls or []))
+    return {"messages": [response], "usage": [usage]}
+
+# tool calls from one agent step run concurrently, at most TOOL_WORKERS at a
+# time so a burst of file reads doesn't saturate the disk
+TOOL_WORKERS = int(os.environ.get("TOOL_WORKERS", 4))
+TOOL_TIMEOUT = float(os.environ.get("TOOL_TIMEOUT", 60))
+tool_executor = ThreadPoolExecutor(max_workers=TOOL_WORKERS, thread_name_prefix="tool")
+tool_executor_lock = threading.Lock()
+
+def replace_tool_executor():
+    """
+    A running tool call can't be interrupted, so a timed-out call is
+    detached: later calls get a fresh pool, and the old pool's threads exit
+    once they finish (the hung one included).
+    """
+    global tool_executor
+    with tool_executor_lock:
+        old_executor = tool_executor
+        tool_executor = ThreadPoolExecutor(max_workers=TOOL_WORKERS, thread_name_prefix="tool")
+    old_executor.shutdown(wait=False)
+
+def run_tool(tool_call, started):
+    started[tool_call["id"]] = time.monotonic()
+    print(f"[DEBUG] Calling tool: {tool_call['name']} with args: {tool_call['args']}")
+    with tracer.span(tool_call["name"], 'tool', args=tool_call["args"]) as span:
+        result = str(tool_map[tool_call["name"]].invoke(tool_call["args"]))
+        span.set(result_chars=len(result))
+    return result
 
 def call_tools(state):
     messages = state["messages"]
     last_msg = messages[-1]
 
     tool_calls = last_msg.tool_calls
-    tool_messages = []
-
-    for tool_call in tool_calls:
-        print(f"[DEBUG] Calling tool: {tool_call['name']} with args: {tool_call['args']}")
-
-        tool_name = tool_call["name"]
-        tool_args = tool_call["args"]
-
-        if tool_name in tool_map:
+    results = {}
+    started = {}
+    futures = {}
+
+    submitted = time.monotonic()
+    # under the lock, so a concurrent turn can't shut the pool down mid-submit
+    with tool_executor_lock:
+        for tool_call in tool_calls:
+            if tool_call["name"] in tool_map:
+                futures[tool_executor.submit(run_tool, tool_call, started)] = tool_call
+            else:
+                results[tool_call["id"]] = f"Unknown tool: {tool_call['name']}"
+                print(f"[ERROR] Unknown tool: {tool_call['name']}")
+
+    # each call gets TOOL_TIMEOUT from the moment it starts running, not from
+    # when it was queued behind other calls; a call still queued after
+    # TOOL_TIMEOUT (every worker busy) is cancelled, so the loop always ends
+    pending = set(futures)
+    while pending:
+        done, pending = wait(pending, timeout=0.05, return_when=FIRST_COMPLETED)
+        for future in done:
+            tool_call = futures[future]
             try:
-                tool_func = tool_map[tool_name]
-                result = tool_func.invoke(tool_args)
-
-                tool_message = ToolMessage(
-                    content = str(result),
-                    tool_call_id = tool_call["id"]
-                )
-                tool_messages.append(tool_message)
+                results[tool_call["id"]] = future.result()
             except Exception as e:
-                error_message = ToolMessage(
-                    content=f"Unknown tool: {tool_name}",
-                    tool_call_id=tool_call["id"]
-                )
-                tool_messages.append(error_message)
-                print(f"[ERROR] Unknown tool: {tool_name}")
-
+                results[tool_call["id"]] = f"Error occurred while running {tool_call['name']}: {e}"
+                print(f"[ERROR] Tool {tool_call['name']} failed: {e}")
+
+        now = time.monotonic()
+        detached = False
+        for future in list(pending):
+            tool_call = futures[future]
+            start = started.get(tool_call["id"])
+            if start is None:
+                # cancel() fails if the call started meanwhile; it is then
+                # timed from its start on the next pass
+                if now - submitted > TOOL_TIMEOUT and future.cancel():
+                    pending.discard(future)
+                    results[tool_call["id"]] = f"Error: {tool_call['name']} did not start within {TOOL_TIMEOUT:.0f}s, all tool workers were busy"
+                    print(f"[ERROR] Tool {tool_call['name']} cancelled before starting")
+            elif now - start > TOOL_TIMEOUT:
+                pending.discard(future)
+                results[tool_call["id"]] = (f"Error: {tool_call['name']} timed out after {TOOL_TIMEOUT:.0f}s; "
+                                            "it was left running in the background and its result is discarded")
+                print(f"[ERROR] Tool {tool_call['name']} timed out, detached")
+                detached = True
+        if detached:
+            replace_tool_executor()
+
+    tool_messages = [
+        ToolMessage(content=results[tool_call["id"]], tool_call_id=tool_call["id"])
+        for tool_call in tool_calls
+    ]
     return {"messages": tool_messages}
 
+refine_cache = RefineCache()
+
 def finetune_query_with_context(state):
     last_msg = next((msg for msg in reversed(state['messages']) if isinstance(msg, HumanMessage)), None)
-    response = ''
+    if not isinstance(last_msg, HumanMessage):
+        return {"messages": []}
 
-    memory = state.get('memory', initialize_memory().copy())
-    memory_context = get_memory_context(memory)
+    query = last_msg.content
 
-    if isinstance(last_msg, HumanMessage):
-        response = llm.invoke(REFINE_QUERY_PROMPT.format(user_query=last_msg, memory_context=memory_context))
+    # greetings and already-precise requests go to the agent as they are
+    kind = classify_query(query)
+    if kind != 'refine':
+        refine_cache.record_skip()
+        print(colored(f'[refine_query]: skipped ({kind})', 'light_blue'))
+        return {"messages": []}
 
-    print(colored(f'[refine_query]: {response}', 'light_blue'))
-    return {"messages": response}
+    memory = state.get('memory', initialize_memory().copy())
+    memory_context = get_memory_context(memory, store=get_recall_store(), query=query, session=state.get('session'))
+
+    refined = refine_cache.get(query, memory_context)
+    if refined is None:
+        prompt = REFINE_QUERY_PROMPT.format(user_query=query, memory_context=memory_context)
+        with tracer.span('refine_query', 'llm') as span:
+            response = get_llm().invoke(prompt)
+            prompt_tokens, response_tokens = token_usage(response, (len(prompt) + 3) // 4)
+            span.set(prompt_tokens=prompt_tokens, response_tokens=response_tokens)
+        refined = response.content
+        refine_cache.put(query, memory_context, refined)
+    else:
+        print(colored('[refine_query]: cache hit', 'light_blue'))
+
+    print(colored(f'[refine_query]: {refined}', 'light_blue'))
+    return {"messages": [AIMessage(content=refined)]}
 
 def plan_response(state):
     last_msg = state['messages'][-1]
@@ -257,12 +639,12 @@ def should_continue(state):
     else:
         return "end"
     
+_graph_start = time.perf_counter()
 workflow = StateGraph(AgentState)
 
-workflow.add_node("agent", call_model)
-workflow.add_node("tools", call_tools)
-workflow.add_node("memory", wrapped_update_memory_node)
-workflow.add_node("refine_query", finetune_query_with_context)
+workflow.add_node("agent", tracer.wrap(call_model, "agent", "node"))
+workflow.add_node("tools", tracer.wrap(call_tools, "tools", "node"))
+workflow.add_node("refine_query", tracer.wrap(finetune_query_with_context, "refine_query", "node"))
 
 workflow.set_entry_point("refine_query")
 
@@ -273,59 +655,168 @@ workflow.add_conditional_edges(
     should_continue,
     {
         "tools": "tools", 
-        "end": "memory",
+        "end": END,
     }
 )
 
 workflow.add_edge("tools", "agent")
 
-workflow.add_edge(
-    "memory",
-    END
-)
-
 graph = workflow.compile()
+warmup.record("graph", time.perf_counter() - _graph_start)
+
+# print answer tokens as they arrive instead of waiting for the whole graph;
+# set STREAM=0 to fall back to graph.invoke
+STREAM = os.environ.get("STREAM", "1") != "0"
+# memory is updated in the background after each answer; WAIT_FOR_MEMORY=1
+# makes the next turn wait for the pending update instead of using the last
+# ready memory
+WAIT_FOR_MEMORY = os.environ.get("WAIT_FOR_MEMORY", "0") == "1"
+
+def stream_turn(initial_state):
+    """
+    Runs one turn through graph.stream, printing tokens from the agent node
+    and tool activity live. Returns the final state and whether any answer
+    text was printed.
+    """
+    result = initial_state
+    streamed = False
+    for mode, chunk in graph.stream(initial_state, stream_mode=["messages", "updates", "values"]):
+        if mode == "messages":
+            message, metadata = chunk
+            if metadata.get("langgraph_node") == "agent" and isinstance(message.content, str) and message.content:
+                print(message.content, end="", flush=True)
+                streamed = True
+        elif mode == "updates":
+            for node, update in chunk.items():
+                if not update or "messages" not in update:
+                    continue
+                if node == "agent":
+                    for msg in update["messages"]:
+                        for tool_call in getattr(msg, "tool_calls", None) or []:
+                            print(colored(f"\n[TOOL] {tool_call['name']}({tool_call['args']})", 'yellow'), flush=True)
+                elif node == "tools":
+                    for msg in update["messages"]:
+                        print(colored(f"[TOOL] done: {len(msg.content)} chars", 'yellow'), flush=True)
+        elif mode == "values":
+            result = chunk
+    return result, streamed
+
+
+def cached_answer(user_query):
+    """
+    Returns (query embedding, cached answer entry or None). Both are None
+    unless ANSWER_CACHE is on.
+    """
+    if not ANSWER_CACHE:
+        return None, None
+    q_emb = embed_text(user_query, get_embed_model())
+    return q_emb, get_answer_cache().lookup(q_emb, refresh_code_index())
+
+def remember_answer(user_query, q_emb, messages):
+    # only answers that came from looking at the code are cached;
+    # small talk depends on memory rather than on the repo
+    final_messages = [msg for msg in messages if isinstance(msg, AIMessage)]
+    used_tools = any(isinstance(msg, ToolMessage) for msg in messages)
+    if ANSWER_CACHE and final_messages and used_tools and not final_messages[-1].tool_calls:
+        code_index = get_code_index()
+        files = contributing_files(messages, code_index)
+        if files is not None:
+            get_answer_cache().store(user_query, q_emb, final_messages[-1].content, files, code_index)
 
 
 if __name__ == '__main__':
 
-    persistent_memory = initialize_memory()
+    warmup.submit("index_watcher", start_index_watcher)
+    warmup.record("time_to_prompt", time.perf_counter() - _import_start)
+    print(colored(f"[LOG] Ready in {warmup.timings['time_to_prompt'] * 1000:.0f} ms, loading index and models "
+                  "in the background (type 'startup' for details).", 'green'))
+    background_memory = BackgroundMemory(get_llm, get_store=get_memory_store)
     while True:
         user_query = input("\nUser: ")
         if user_query.lower() == 'exit':
             break
         elif user_query.lower() == 'memory':
+            persistent_memory = background_memory.current()
             print(f"\nMemory state:")
+            if background_memory.pending():
+                print("(update in progress)")
             print(f"Files explored: {list(persistent_memory.get('files_explored', []))}")
             print(f"Key findings: {len(persistent_memory.get('key_findings', []))} stored")
             if persistent_memory.get('key_findings'):
                 print("Recent findings:")
                 for finding in persistent_memory['key_findings'][-3:]:
                     print(f"  - {finding['content'][:100]}...")
+            if warmup.loaded("memory_store"):
+                print(f"Long-term findings: {len(get_memory_store())} stored")
+            continue
+        elif user_query.lower() == 'stats':
+            stats = refine_cache.stats()
+            print(f"refine_query: {stats['queries']} queries, {stats['skipped']} skipped, "
+                  f"{stats['hits']} cache hits, {stats['misses']} LLM calls "
+                  f"({stats['llm_calls_saved']:.0%} saved)")
+            if ANSWER_CACHE:
+                stats = get_answer_cache().stats()
+                print(f"answer cache: {stats['entries']} entries, {stats['hits']} hits, {stats['misses']} misses")
+            if warmup.loaded("retrieval"):
+                report = get_embedding_store().memory_report()
+                print(f"embedding store: {report['rows']} vectors ({report['quantization']}), "
+                      f"{report['scan_bytes'] / 2**20:.1f} MB in RAM vs {report['float32_bytes'] / 2**20:.1f} MB "
+                      f"float32 ({report['saved']:.0%} saved)")
+            if warmup.loaded("embed_model"):
+                stats = get_embed_model().stats()
+                print(f"embeddings: {stats['requests']} requests in {stats['batches']} batches "
+                      f"(mean {stats['mean_batch']:.1f}, max {stats['max_batch']}), "
+                      f"queue p50 {stats['queue_p50_ms']:.1f} ms, p95 {stats['queue_p95_ms']:.1f} ms")
+            print(tracer.report())
+            continue
+        elif user_query.lower() == 'trace':
+            trace_dir = get_code_index().index_dir
+            tracer.write_jsonl(os.path.join(trace_dir, 'trace.jsonl'))
+            tracer.write_chrome_trace(os.path.join(trace_dir, 'trace.json'))
+            print(f"Wrote {len(tracer.snapshot())} spans to {trace_dir}/trace.jsonl and trace.json (chrome://tracing)")
+            continue
+        elif user_query.lower() == 'startup':
+            print(warmup.report())
             continue
         elif user_query.lower() == 'clear':
-            persistent_memory = initialize_memory()
-            print("Memory cleared!")
+            background_memory.clear()
+            print("Memory and long-term findings cleared!")
             continue
 
         print("\nAgent: ", end="", flush=True)
         try:
+            q_emb, cached = cached_answer(user_query)
+            if cached is not None:
+                print(f"\n[CACHED] {cached['answer']}")
+                print()
+                continue
+
             initial_state = {
                 "messages": [HumanMessage(content=user_query)],
-                "memory": persistent_memory
+                "memory": background_memory.current(wait=WAIT_FOR_MEMORY)
             }
-            result = graph.invoke(initial_state)
-            
-            persistent_memory = result.get("memory", persistent_memory)
+            if STREAM:
+                result, streamed = stream_turn(initial_state)
+            else:
+                result, streamed = graph.invoke(initial_state), False
             
             final_messages = [msg for msg in result['messages'] if isinstance(msg, AIMessage)]
-            if final_messages:
+            if final_messages and not streamed:
                 final_response = final_messages[-1]
                 if not hasattr(final_response, 'tool_calls') or not final_response.tool_calls:
                     print(f"\n[FINAL] {final_response.content}")
 
+            remember_answer(user_query, q_emb, result['messages'])
+
+            usage = result.get('usage') or []
+            if usage:
+                print(colored(f"\n[LOG] turn used {sum(u['total'] for u in usage)} prompt tokens over "
+                              f"{len(usage)} model calls (largest {max(u['total'] for u in usage)}"
+                              f"/{CONTEXT_BUDGET})", 'green'))
+
+            background_memory.submit(result['messages'])
 
         except Exception as e:
             print(f"Error: {e}")
 
-        print()  
\ No newline at end of file
+        print()
@@ -0,0 +1,275 @@
+import threading
+
+import numpy as np
+
+from parse import tag_text
+from tags import StaleIndexError
+
+# the store is compacted once this many rows, and compact_ratio of the live
+# rows, are no longer referenced by any tag
+COMPACT_MIN_ROWS = 1024
+
+
+def kmeans(vectors, k, iters=10, sample_per_centroid=64, seed=0):
+    rng = np.random.default_rng(seed)
+    n = len(vectors)
+    sample_idx = rng.choice(n, min(n, k * sample_per_centroid), replace=False)
+    sample = np.asarray(vectors[np.sort(sample_idx)], dtype=np.float32)
+    centroids = sample[rng.choice(len(sample), k, replace=False)].copy()
+
+    for _ in range(iters):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        counts = np.bincount(assign, minlength=k)
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+        norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+        centroids /= np.maximum(norms, 1e-12)
+    return centroids
+
+
+class IVFIndex:
+    """
+    Inverted-file index over normalized vectors. Vectors are bucketed by their
+    nearest k-means centroid; a search scores the nprobe closest buckets
+    instead of every vector. nprobe trades recall for latency. Below
+    exact_threshold vectors (or before build() is called) search is exact.
+
+    The index only holds ids; the vectors are passed to build/add, and search
+    takes a scoring function, so they can stay in the memory-mapped embedding
+    store and candidates can be scored from its quantized copy.
+    """
+
+    def __init__(self, nlist=None, nprobe=8, exact_threshold=20000):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.exact_threshold = exact_threshold
+
+        self.centroids = None
+        self.list_ids = None
+        self.list_offsets = None
+        self.pending = {}
+        self.live = set()
+        self.deleted = set()
+
+    def __len__(self):
+        return len(self.live)
+
+    @property
+    def is_built(self):
+        return self.centroids is not None
+
+    def _assign(self, vectors, chunk=65536):
+        assign = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), chunk):
+            block = np.asarray(vectors[start:start + chunk], dtype=np.float32)
+            assign[start:start + chunk] = np.argmax(block @ self.centroids.T, axis=1)
+        return assign
+
+    def build(self, ids, vectors):
+        ids = np.asarray(ids, dtype=np.int64)
+        self.live = set(ids.tolist())
+        self.deleted = set()
+        self.pending = {}
+
+        if len(ids) < self.exact_threshold:
+            self.centroids = None
+            self.list_ids = None
+            self.list_offsets = None
+            return
+
+        nlist = self.nlist or max(1, int(np.sqrt(len(ids))))
+        member_vectors = vectors[ids]
+        self.centroids = kmeans(member_vectors, nlist)
+
+        assign = self._assign(member_vectors)
+        order = np.argsort(assign, kind='stable')
+        self.list_ids = ids[order]
+        self.list_offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assign, minlength=nlist), out=self.list_offsets[1:])
+
+    def add(self, ids, vectors):
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(ids) == 0:
+            return
+        self.live.update(ids.tolist())
+        self.deleted.difference_update(ids.tolist())
+        if not self.is_built:
+            return
+        for list_no, id_ in zip(self._assign(vectors[ids]).tolist(), ids.tolist()):
+            self.pending.setdefault(list_no, []).append(id_)
+
+    def remove(self, ids):
+        ids = [int(id_) for id_ in ids]
+        self.live.difference_update(ids)
+        if self.is_built:
+            self.deleted.update(ids)
+
+    def remap(self, mapping):
+        """
+        Renumbers ids after the vectors were compacted: mapping[old] is the
+        new id, or -1 for one that was dropped.
+        """
+        mapping = np.asarray(mapping, dtype=np.int64)
+        live = mapping[np.fromiter(self.live, dtype=np.int64, count=len(self.live))]
+        self.live = set(live[live >= 0].tolist())
+        # deleted ids aren't live, so compaction dropped them all
+        self.deleted = set()
+        pending = {}
+        for list_no, ids in self.pending.items():
+            new_ids = mapping[np.asarray(ids, dtype=np.int64)]
+            if (new_ids >= 0).any():
+                pending[list_no] = new_ids[new_ids >= 0].tolist()
+        self.pending = pending
+        if self.is_built:
+            nlist = len(self.list_offsets) - 1
+            list_nos = np.repeat(np.arange(nlist), np.diff(self.list_offsets))
+            new_ids = mapping[self.list_ids]
+            keep = new_ids >= 0
+            self.list_ids = new_ids[keep]
+            self.list_offsets = np.zeros(nlist + 1, dtype=np.int64)
+            np.cumsum(np.bincount(list_nos[keep], minlength=nlist), out=self.list_offsets[1:])
+
+    def needs_rebuild(self):
+        if not self.is_built:
+            return len(self.live) >= self.exact_threshold
+        churn = len(self.deleted) + sum(len(ids) for ids in self.pending.values())
+        return churn > 0.2 * max(len(self.live), 1)
+
+    def _candidates(self, q, nprobe):
+        probe = np.argsort(-(self.centroids @ q))[:nprobe]
+        parts = [self.list_ids[self.list_offsets[i]:self.list_offsets[i + 1]] for i in probe]
+        parts.extend(np.asarray(self.pending[i], dtype=np.int64) for i in probe if i in self.pending)
+        candidates = np.unique(np.concatenate(parts)) if parts else np.zeros(0, dtype=np.int64)
+        if self.deleted:
+            candidates = candidates[~np.isin(candidates, list(self.deleted))]
+        return candidates
+
+    def search(self, q, score, k=10, nprobe=None):
+        """
+        Returns (ids, scores) of the k best candidates, scored by
+        score(ids, q).
+        """
+        q = np.asarray(q, dtype=np.float32)
+        if self.is_built:
+            candidates = self._candidates(q, nprobe or self.nprobe)
+        else:
+            candidates = np.fromiter(sorted(self.live), dtype=np.int64, count=len(self.live))
+        if len(candidates) == 0:
+            return candidates, np.zeros(0, dtype=np.float32)
+
+        scores = np.asarray(score(candidates, q), dtype=np.float32)
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return candidates[top], scores[top]
+
+
+class TagANN:
+    """
+    Keeps an IVFIndex over the embedding-store rows of the tags in a
+    CodeIndex, and maps search hits back to tag positions in all_tags().
+    sync() is a no-op until the code index generation changes; after that only
+    the tags of changed files are looked up in the store, and only the rows of
+    added/removed tags are inserted into or deleted from the IVF lists.
+    tag_rows (store row of every tag, in all_tags() order) is kept for exact
+    scoring below the IVF threshold.
+
+    Rows of edited or deleted tags stay in the store; once more than
+    compact_ratio of the live rows (and COMPACT_MIN_ROWS) are unreferenced,
+    the store is compacted and every row number held here is remapped.
+    """
+
+    def __init__(self, store, nprobe=8, exact_threshold=20000, compact_ratio=0.5):
+        self.store = store
+        self.ivf = IVFIndex(nprobe=nprobe, exact_threshold=exact_threshold)
+        self.compact_ratio = compact_ratio
+        self.generation = None
+        self.store_epoch = None
+        self.tag_rows = np.zeros(0, dtype=np.int64)
+        # file_path -> (FileTags, store rows of its tags)
+        self.file_rows = {}
+        self._row_order = np.zeros(0, dtype=np.int64)
+        self._sorted_rows = np.zeros(0, dtype=np.int64)
+        self.lock = threading.Lock()
+
+    def sync(self, code_index, model):
+        with self.lock:
+            self._sync(code_index, model)
+
+    def _sync(self, code_index, model):
+        if self.generation == code_index.generation and self.store_epoch == self.store.epoch:
+            return
+        generation, tables = code_index.snapshot()
+        # another holder of the store compacted it, so every row held here is stale
+        stale = self.store_epoch != self.store.epoch
+        if stale:
+            self.file_rows = {}
+
+        # one store lookup for every changed file, so a cold start embeds in bulk
+        changed = [path for path, table in tables.items() if self.file_rows.get(path, (None,))[0] is not table]
+        texts = [tag_text(tag) for path in changed for tag in tables[path]]
+        changed_rows = self.store.lookup(texts, model) if texts else np.zeros(0, dtype=np.int64)
+        file_rows = {path: self.file_rows[path] for path in tables if path not in changed}
+        offset = 0
+        for path in changed:
+            count = len(tables[path])
+            file_rows[path] = (tables[path], changed_rows[offset:offset + count])
+            offset += count
+
+        parts = [file_rows[path][1] for path in sorted(file_rows)]
+        rows = np.concatenate(parts).astype(np.int64) if parts else np.zeros(0, dtype=np.int64)
+
+        new_rows = set(rows.tolist())
+        if stale or self.ivf.needs_rebuild() or not self.ivf.live:
+            self.ivf.build(sorted(new_rows), self.store.vectors)
+        else:
+            self.ivf.remove(self.ivf.live - new_rows)
+            self.ivf.add(sorted(new_rows - self.ivf.live), self.store.vectors)
+            if self.ivf.needs_rebuild():
+                self.ivf.build(sorted(new_rows), self.store.vectors)
+
+        dead = len(self.store) - len(new_rows)
+        if dead > max(COMPACT_MIN_ROWS, self.compact_ratio * len(new_rows)):
+            print(f'[LOG] compacting embedding store: dropping {dead} unreferenced rows...')
+            mapping = self.store.compact(sorted(new_rows))
+            rows = mapping[rows]
+            file_rows = {path: (table, mapping[table_rows]) for path, (table, table_rows) in file_rows.items()}
+            self.ivf.remap(mapping)
+
+        self.file_rows = file_rows
+        self.tag_rows = rows
+        self._row_order = np.argsort(rows, kind='stable')
+        self._sorted_rows = rows[self._row_order]
+        self.generation = generation
+        self.store_epoch = self.store.epoch
+
+    def search(self, q, k=200, nprobe=None, generation=None):
+        """
+        Returns (tag positions, scores): the k best matching tags once the
+        IVF index is built, otherwise every tag in all_tags() order. With a
+        generation, raises StaleIndexError unless the index is synced to it.
+        """
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                raise StaleIndexError(f'tag ANN is at generation {self.generation}, tags at {generation}')
+            if self.store_epoch != self.store.epoch:
+                raise StaleIndexError(f'tag ANN rows are from store epoch {self.store_epoch}, store at {self.store.epoch}')
+            if not self.ivf.is_built:
+                return np.arange(len(self.tag_rows)), self.store.score(self.tag_rows, q)
+            # quantized stores scan their compact codes and rescore at least
+            # the k returned rows in float32
+            rescore = max(k, self.store.rescore)
+            rows, scores = self.ivf.search(
+                q, lambda ids, q: self.store.score(ids, q, rescore=rescore), k=k, nprobe=nprobe)
+            lo = np.searchsorted(self._sorted_rows, rows, side='left')
+            hi = np.searchsorted(self._sorted_rows, rows, side='right')
+            row_order = self._row_order
+        positions = []
+        tag_scores = []
+        for start, end, score in zip(lo.tolist(), hi.tolist(), scores.tolist()):
+            for pos in row_order[start:end].tolist():
+                positions.append(pos)
+                tag_scores.append(score)
+        return np.asarray(positions, dtype=np.int64), np.asarray(tag_scores, dtype=np.float32)
@@ -0,0 +1,169 @@
+import json
+import os
+import re
+import threading
+import time
+
+import numpy as np
+
+from index import content_hash
+
+ANSWER_CACHE_FILE = 'answer_cache.json'
+# entries before version 2 dropped the non-indexed files they were built from
+ANSWER_CACHE_VERSION = 2
+# tools whose output can't be tied to file contents, e.g. directory listings
+UNTRACKED_TOOLS = ('get_directory_contents',)
+
+# absolute paths to python files mentioned in tool output
+PATH_RE = re.compile(r'(/[^\s\'",:]+\.py)\b')
+
+
+def contributing_files(messages, code_index):
+    """
+    Files whose content an answer depended on: files read with
+    get_code_file_contents (indexed or not) plus any indexed file named in a
+    tool result. None if a tool in UNTRACKED_TOOLS was used, since then the
+    answer can't be invalidated by file changes.
+    """
+    from langchain_core.messages import AIMessage, ToolMessage
+
+    files = set()
+    for msg in messages:
+        if isinstance(msg, AIMessage):
+            for tool_call in msg.tool_calls or []:
+                if tool_call['name'] in UNTRACKED_TOOLS:
+                    return None
+                file_name = tool_call['args'].get('file_name')
+                if tool_call['name'] == 'get_code_file_contents' and file_name:
+                    files.add(os.path.abspath(file_name))
+        elif isinstance(msg, ToolMessage):
+            for path in PATH_RE.findall(str(msg.content)):
+                if path in code_index.files:
+                    files.add(path)
+    return sorted(files)
+
+
+class AnswerCache:
+    """
+    Opt-in cache of final answers keyed by query embedding similarity. An
+    entry is only served if its best match is above `threshold` and none of
+    the files that contributed to the answer have changed since (compared by
+    content hash: from the code index for indexed files, read directly for
+    others such as README.md or config files). Bounded to max_size entries with LRU
+    eviction, and persisted as JSON next to the code index.
+    """
+
+    def __init__(self, index_dir, model_name, threshold=0.95, max_size=256):
+        self.path = os.path.join(index_dir, ANSWER_CACHE_FILE)
+        self.model_name = model_name
+        self.threshold = threshold
+        self.max_size = max_size
+
+        self.entries = []
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='UTF-8') as f:
+                data = json.load(f)
+        except Exception as e:
+            print(f'[LOG] discarding unreadable answer cache {self.path}: {e}')
+            return
+        if data.get('version') != ANSWER_CACHE_VERSION or data.get('model') != self.model_name:
+            return
+        if not data.get('entries'):
+            return
+        self.entries = data['entries']
+        self.vectors = np.asarray([entry.pop('vector') for entry in self.entries], dtype=np.float32)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        entries = [dict(entry, vector=vector.tolist()) for entry, vector in zip(self.entries, self.vectors)]
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='UTF-8') as f:
+            json.dump({'version': ANSWER_CACHE_VERSION, 'model': self.model_name, 'entries': entries}, f)
+        os.replace(tmp_path, self.path)
+
+    def _drop(self, positions):
+        positions = set(positions)
+        keep = [i for i in range(len(self.entries)) if i not in positions]
+        self.entries = [self.entries[i] for i in keep]
+        self.vectors = self.vectors[keep] if keep else np.zeros((0, self.vectors.shape[1]), dtype=np.float32)
+
+    def _digest(self, file_path, code_index):
+        """
+        Content hash of file_path, None if it can't be read.
+        """
+        meta = code_index.files.get(file_path)
+        if meta is not None:
+            return meta['hash']
+        try:
+            with open(file_path, 'rb') as f:
+                return content_hash(f.read())
+        except OSError:
+            return None
+
+    def _is_fresh(self, entry, code_index):
+        return all(self._digest(file_path, code_index) == digest for file_path, digest in entry['files'].items())
+
+    def lookup(self, q_emb, code_index):
+        with self._lock:
+            if not self.entries:
+                self.misses += 1
+                return None
+            scores = self.vectors @ np.asarray(q_emb, dtype=np.float32)
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                self.misses += 1
+                return None
+
+            entry = self.entries[best]
+            if not self._is_fresh(entry, code_index):
+                self._drop([best])
+                self.save()
+                self.misses += 1
+                return None
+
+            entry['last_used'] = time.time()
+            self.hits += 1
+            return entry
+
+    def store(self, query, q_emb, answer, files, code_index):
+        q_emb = np.asarray(q_emb, dtype=np.float32).reshape(1, -1)
+        with self._lock:
+            entry = {
+                'query': query,
+                'answer': answer,
+                'files': {f: self._digest(f, code_index) for f in files},
+                'created': time.time(),
+                'last_used': time.time(),
+            }
+            if self.vectors.size == 0:
+                self.vectors = q_emb
+            else:
+                self.vectors = np.vstack([self.vectors, q_emb])
+            self.entries.append(entry)
+
+            if len(self.entries) > self.max_size:
+                lru = sorted(range(len(self.entries)), key=lambda i: self.entries[i]['last_used'])
+                self._drop(lru[:len(self.entries) - self.max_size])
+            self.save()
+
+    def invalidate(self, file_paths):
+        file_paths = set(file_paths)
+        with self._lock:
+            stale = [i for i, entry in enumerate(self.entries) if file_paths & set(entry['files'])]
+            if stale:
+                self._drop(stale)
+                self.save()
+        return len(stale)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
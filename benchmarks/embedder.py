@@ -0,0 +1,32 @@
+import re
+import zlib
+
+import numpy as np
+
+TOKEN_RE = re.compile(r'[A-Za-z]+|[0-9]+')
+
+
+class HashEmbedder:
+    """
+    Deterministic offline stand-in for SentenceTransformer: hashed bag of
+    lowercased word pieces (snake_case and CamelCase split), L2-normalized.
+    Texts that share words get similar vectors, so rankings are meaningful
+    enough to benchmark, and no model download or GPU is needed.
+    """
+
+    def __init__(self, dim=256):
+        self.dim = dim
+
+    def _embed_one(self, text):
+        vec = np.zeros(self.dim, dtype=np.float32)
+        for token in TOKEN_RE.findall(text):
+            h = zlib.crc32(token.lower().encode('UTF-8'))
+            vec[h % self.dim] += 1.0 if (h >> 16) & 1 else -1.0
+        return vec
+
+    def encode(self, texts, batch_size=256, normalize_embeddings=True, **kwargs):
+        single = isinstance(texts, str)
+        vectors = np.stack([self._embed_one(t) for t in ([texts] if single else texts)]) if texts else np.zeros((0, self.dim), dtype=np.float32)
+        if normalize_embeddings and len(vectors):
+            vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        return vectors[0] if single else vectors
@@ -0,0 +1,212 @@
+"""
+Times the retrieval pipeline on synthetic repos of increasing size.
+
+    python -m benchmarks.run --files 100 1000 10000 --output results.json
+
+Stages: generate, walk, parse_codebase (serial), parse_files (process pool),
+index (CodeIndex.refresh from scratch), tag_build, lexical, depgraph,
+symbols, embed (cold and warm EmbeddingStore), ann, exact_sync, and per
+query score (semantic_scores over every tag) and rank (weights_for_query
+with every retrieval component). Quantized float16/int8 stores are timed
+too, exact (score_*) and through the IVF (ann_*), with their memory use
+and recall@10 against float32. The save_*
+stages time re-syncing each component after one file is saved.
+Embeddings come from HashEmbedder, so results are deterministic and need
+no model download.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ann import TagANN
+from benchmarks.embedder import HashEmbedder
+from benchmarks.synthetic import generate_repo, sample_queries
+from depgraph import DependencyGraph
+from embeddings import EmbeddingStore
+from index import CodeIndex
+from lexical import LexicalIndex
+from parse import parse_codebase, parse_files, semantic_scores, tag_text, weights_for_query
+from symbols import SymbolTable
+
+
+class StageTimer:
+
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        yield
+        self.stages[name] = round(time.perf_counter() - start, 6)
+        print(f'[LOG] {name}: {self.stages[name] * 1000:.1f} ms')
+
+    def per_query(self, name, fn, queries):
+        times = []
+        for query in queries:
+            start = time.perf_counter()
+            fn(query)
+            times.append(time.perf_counter() - start)
+        times = np.asarray(times)
+        self.stages[name] = {
+            'mean': round(float(times.mean()), 6),
+            'p50': round(float(np.percentile(times, 50)), 6),
+            'p95': round(float(np.percentile(times, 95)), 6),
+        }
+        print(f"[LOG] {name}: mean {times.mean() * 1000:.1f} ms, p95 {np.percentile(times, 95) * 1000:.1f} ms")
+
+
+def run_size(root_dir, files, args):
+    timer = StageTimer()
+    model = HashEmbedder(dim=args.dim)
+
+    with timer.stage('generate'):
+        paths = generate_repo(root_dir, files=files, functions_per_file=args.functions,
+                              call_density=args.call_density, seed=args.seed)
+
+    code_index = CodeIndex(root_dir, workers=args.workers)
+    with timer.stage('walk'):
+        walked = list(code_index.walk())
+
+    if not args.skip_serial:
+        with timer.stage('parse_codebase'):
+            parse_codebase(root_dir)
+
+    with timer.stage('parse_files'):
+        parse_files(walked, workers=args.workers)
+
+    with timer.stage('index'):
+        code_index.refresh()
+
+    with timer.stage('tag_build'):
+        all_tags = code_index.all_tags()
+        texts = [tag_text(tag) for tag in all_tags]
+
+    lexical = LexicalIndex()
+    with timer.stage('lexical'):
+        lexical.sync(code_index)
+
+    graph = DependencyGraph(code_index.root_dir, code_index.index_dir)
+    with timer.stage('depgraph'):
+        graph.build(code_index)
+
+    symbol_table = SymbolTable()
+    with timer.stage('symbols'):
+        symbol_table.sync(code_index, graph)
+
+    store = EmbeddingStore(os.path.join(code_index.index_dir, 'embeddings'), f'hash-embedder-{args.dim}')
+    with timer.stage('embed_cold'):
+        store.embed(texts, model)
+    with timer.stage('embed_warm'):
+        store.embed(texts, model)
+
+    tag_ann = TagANN(store, nprobe=args.nprobe, exact_threshold=args.exact_threshold)
+    with timer.stage('ann'):
+        tag_ann.sync(code_index, model)
+    # scores every tag, whatever the repo size
+    exact_ann = TagANN(store, exact_threshold=sys.maxsize)
+    with timer.stage('exact_sync'):
+        exact_ann.sync(code_index, model)
+
+    queries = sample_queries(root_dir, count=args.queries, seed=args.seed)
+    timer.per_query('score', lambda q: semantic_scores(q, all_tags, model, ann=exact_ann), queries)
+    timer.per_query('rank', lambda q: weights_for_query(
+        q, all_tags, model, store=store, ann=tag_ann, lexical=lexical, graph=graph), queries)
+
+    # compact first-pass copies of the same store, rescored in float32
+    quantization = {}
+    q_embs = model.encode(queries)
+    for kind in ('float16', 'int8'):
+        with timer.stage(f'quantize_{kind}'):
+            quantized = EmbeddingStore(os.path.join(code_index.index_dir, 'embeddings'), f'hash-embedder-{args.dim}',
+                                       quantization=kind, rescore=args.rescore)
+            quantized_ann = TagANN(quantized, exact_threshold=sys.maxsize)
+            quantized_ann.sync(code_index, model)
+        timer.per_query(f'score_{kind}', lambda q: semantic_scores(q, all_tags, model, ann=quantized_ann), queries)
+        quantized_ivf = TagANN(quantized, nprobe=args.nprobe, exact_threshold=args.exact_threshold)
+        quantized_ivf.sync(code_index, model)
+        timer.per_query(f'ann_{kind}', lambda q: semantic_scores(q, all_tags, model, ann=quantized_ivf), queries)
+        quantization[kind] = dict(quantized.memory_report(), **quantized.recall_report(q_embs, k=10))
+
+    # one saved file, as the watcher sees it: only the derived state of that
+    # file should be recomputed
+    with open(paths[len(paths) // 2], 'a', encoding='UTF-8') as f:
+        f.write('\n\ndef benchmark_saved_function(value):\n    return value\n')
+    with timer.stage('save_refresh'):
+        generation, changes = code_index.refresh([paths[len(paths) // 2]])
+    with timer.stage('save_lexical'):
+        lexical.sync(code_index)
+    with timer.stage('save_depgraph'):
+        graph.sync(code_index, changes, generation)
+    with timer.stage('save_symbols'):
+        symbol_table.sync(code_index, graph)
+    with timer.stage('save_ann'):
+        tag_ann.sync(code_index, model)
+
+    return {
+        'files': len(paths),
+        'tags': len(all_tags),
+        'functions_per_file': args.functions,
+        'call_density': args.call_density,
+        'queries': len(queries),
+        'stages': timer.stages,
+        'quantization': quantization,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, nargs='+', default=[100, 1000], help='repo sizes to benchmark')
+    parser.add_argument('--functions', type=int, default=10, help='functions per file')
+    parser.add_argument('--call-density', type=float, default=0.3, help='share of functions calling another module')
+    parser.add_argument('--queries', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--dim', type=int, default=256, help='HashEmbedder dimensions')
+    parser.add_argument('--nprobe', type=int, default=8)
+    parser.add_argument('--rescore', type=int, default=300, help='float32 rescoring candidates for quantized stores')
+    parser.add_argument('--exact-threshold', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--skip-serial', action='store_true', help='skip the serial parse_codebase stage')
+    parser.add_argument('--output', help='write JSON results here instead of stdout')
+    parser.add_argument('--keep', help='generate repos under this directory and keep them')
+    args = parser.parse_args(argv)
+
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'workers': args.workers,
+        'runs': [],
+    }
+    base_dir = args.keep or tempfile.mkdtemp(prefix='speak_code_bench_')
+    try:
+        for files in args.files:
+            print(f'[LOG] benchmarking {files} files')
+            root_dir = os.path.join(base_dir, f'repo_{files}')
+            shutil.rmtree(root_dir, ignore_errors=True)
+            results['runs'].append(run_size(root_dir, files, args))
+    finally:
+        if not args.keep:
+            shutil.rmtree(base_dir, ignore_errors=True)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='UTF-8') as f:
+            f.write(output)
+        print(f'[LOG] results written to {args.output}')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
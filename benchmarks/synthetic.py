@@ -0,0 +1,106 @@
+import os
+import random
+
+WORDS = [
+    'account', 'balance', 'cache', 'client', 'config', 'customer', 'database', 'event', 'export', 'invoice',
+    'ledger', 'market', 'order', 'payment', 'portfolio', 'price', 'report', 'request', 'session', 'stock',
+    'token', 'trade', 'user', 'worker', 'queue', 'schema', 'record', 'alert', 'budget', 'profile',
+]
+VERBS = ['get', 'load', 'save', 'update', 'compute', 'validate', 'parse', 'build', 'send', 'fetch', 'merge', 'sync']
+
+
+def _name(rng, parts=2):
+    return '_'.join(rng.choice(WORDS) for _ in range(parts))
+
+
+def generate_repo(root_dir, files=100, functions_per_file=10, call_density=0.3, files_per_package=50,
+                  classes_per_file=1, seed=0):
+    """
+    Writes a synthetic Python package tree under root_dir and returns the
+    list of file paths. Each module has top-level functions and classes
+    with methods; about call_density of the functions call a function from
+    another module, imported with a relative or absolute import. The same
+    seed always produces the same tree.
+    """
+    rng = random.Random(seed)
+    os.makedirs(root_dir, exist_ok=True)
+
+    modules = []
+    for i in range(files):
+        package = f"pkg_{i // files_per_package:03d}"
+        modules.append((package, f"{rng.choice(WORDS)}_{i:05d}"))
+
+    # function names per module, decided up front so calls can target them
+    functions = [
+        [f"{rng.choice(VERBS)}_{_name(rng)}_{i}_{j}" for j in range(functions_per_file)]
+        for i in range(files)
+    ]
+
+    paths = []
+    for package in sorted({package for package, _ in modules}):
+        package_dir = os.path.join(root_dir, package)
+        os.makedirs(package_dir, exist_ok=True)
+        with open(os.path.join(package_dir, '__init__.py'), 'w', encoding='UTF-8') as f:
+            f.write(f'"""Synthetic package {package}."""\n')
+        paths.append(os.path.join(package_dir, '__init__.py'))
+
+    for i, (package, module) in enumerate(modules):
+        imports = {}
+        bodies = []
+        for j, function in enumerate(functions[i]):
+            arg = rng.choice(WORDS)
+            lines = [f"def {function}({arg}, limit=10):", f'    """{function.replace("_", " ").capitalize()}."""']
+            if files > 1 and rng.random() < call_density:
+                k = rng.randrange(files)
+                if k == i:
+                    k = (k + 1) % files
+                target = rng.choice(functions[k])
+                target_package, target_module = modules[k]
+                if target_package == package:
+                    imports[target] = f"from .{target_module} import {target}"
+                else:
+                    imports[target] = f"from {target_package}.{target_module} import {target}"
+                lines.append(f"    result = {target}({arg})")
+            else:
+                lines.append(f"    result = [{arg} for _ in range(limit)]")
+            if j > 0:
+                lines.append(f"    result = {functions[i][j - 1]}(result)")
+            lines.append("    return result")
+            bodies.append('\n'.join(lines))
+
+        for c in range(classes_per_file):
+            class_name = ''.join(w.capitalize() for w in _name(rng).split('_')) + f"Service{c}"
+            methods = [f"class {class_name}:", f"    default_limit = {rng.randint(1, 100)}", "",
+                       "    def __init__(self, store):", "        self.store = store"]
+            for function in rng.sample(functions[i], min(3, len(functions[i]))):
+                methods += ["", f"    def {function.split('_', 1)[0]}_{c}(self, key):",
+                            f"        return {function}(self.store.get(key), limit=self.default_limit)"]
+            bodies.append('\n'.join(methods))
+
+        source = '\n'.join(sorted(imports.values()))
+        source += f"\n\nDEFAULT_{module.upper()} = {rng.randint(0, 1000)}\n\n\n" + '\n\n\n'.join(bodies) + '\n'
+        path = os.path.join(root_dir, package, f"{module}.py")
+        with open(path, 'w', encoding='UTF-8') as f:
+            f.write(source)
+        paths.append(path)
+    return paths
+
+
+def sample_queries(root_dir, count=10, seed=0):
+    """
+    A mix of prose and identifier queries against a generated repo.
+    """
+    rng = random.Random(seed)
+    identifiers = []
+    for root, _, files in os.walk(root_dir):
+        for file in files:
+            if file.endswith('.py') and file != '__init__.py':
+                with open(os.path.join(root, file), encoding='UTF-8') as f:
+                    identifiers += [line[4:line.index('(')] for line in f if line.startswith('def ')]
+    queries = []
+    for i in range(count):
+        if i % 2 and identifiers:
+            queries.append(f"where is {rng.choice(identifiers)} defined")
+        else:
+            queries.append(f"how do we {rng.choice(VERBS)} the {rng.choice(WORDS)} {rng.choice(WORDS)}")
+    return queries
@@ -0,0 +1,174 @@
+import os
+import re
+
+# ~4 characters per token for code and English; close enough for budgeting
+# without a round trip to the model's tokenizer
+CHARS_PER_TOKEN = 4
+
+# header of one ranked tag in get_relevant_code output
+SNIPPET_RE = re.compile(r'^--- (?P<path>\S+):(?P<start>\d+)-(?P<end>\d+) .*$', re.M)
+# header get_code_file_contents puts on partial reads
+LINES_RE = re.compile(r'^\[lines (\d+)-(\d+) of (\d+)\]\n')
+
+
+def count_tokens(text):
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN if text else 0
+
+
+def trim_to_tokens(text, max_tokens, keep='head'):
+    """
+    Cuts text to about max_tokens at a line boundary, keeping the start
+    (keep='head') or the end (keep='tail').
+    """
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    if keep == 'tail':
+        cut = text[-max_chars:]
+        newline = cut.find('\n')
+        return cut[newline + 1:] if 0 <= newline < len(cut) - 1 else cut
+    cut = text[:max_chars]
+    newline = cut.rfind('\n')
+    return cut[:newline] if newline > 0 else cut
+
+
+def split_snippets(content):
+    """
+    Splits get_relevant_code output into (preamble, [(path, start, end, block)])
+    in rank order.
+    """
+    matches = list(SNIPPET_RE.finditer(content))
+    if not matches:
+        return content, []
+    snippets = []
+    for i, match in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(content)
+        snippets.append((match['path'], int(match['start']), int(match['end']), content[match.start():end]))
+    return content[:matches[0].start()], snippets
+
+
+def file_read_range(tool_call, content):
+    """
+    (path, start, end) covered by a get_code_file_contents result, or None.
+    """
+    if tool_call is None or tool_call['name'] != 'get_code_file_contents' or content.startswith('Error'):
+        return None
+    file_name = tool_call['args'].get('file_name')
+    if not file_name:
+        return None
+    match = LINES_RE.match(content)
+    if match:
+        return os.path.abspath(file_name), int(match[1]), int(match[2])
+    return os.path.abspath(file_name), 1, float('inf')
+
+
+class ContextPacker:
+    """
+    Fits the prompt built by call_model into a token budget. The system
+    prompt and the conversation are kept as they are; memory context gets at
+    most memory_share of the budget (most recent part kept) and tool outputs
+    share what is left. Tag snippets already covered by a file read in the
+    same context are dropped, then the lowest-ranked snippets, then the tail
+    of the oldest tool outputs, until everything fits.
+    """
+
+    def __init__(self, budget=32000, memory_share=0.15):
+        self.budget = budget
+        self.memory_share = memory_share
+
+    def pack(self, system_prompt, memory_context, messages):
+        """
+        Returns (memory_context, messages, usage) where usage holds the
+        per-section token counts after packing.
+        """
+        from langchain_core.messages import AIMessage, ToolMessage
+
+        usage = {'budget': self.budget, 'deduplicated': 0, 'trimmed': 0}
+        usage['system'] = count_tokens(system_prompt)
+
+        memory_budget = int(self.budget * self.memory_share)
+        if count_tokens(memory_context) > memory_budget:
+            memory_context = trim_to_tokens(memory_context, memory_budget, keep='tail')
+            usage['trimmed'] += 1
+        usage['memory'] = count_tokens(memory_context)
+
+        tool_calls = {}
+        for msg in messages:
+            if isinstance(msg, AIMessage):
+                for tool_call in msg.tool_calls or []:
+                    tool_calls[tool_call['id']] = tool_call
+
+        tool_positions = [i for i, msg in enumerate(messages) if isinstance(msg, ToolMessage)]
+        usage['conversation'] = sum(
+            count_tokens(str(msg.content)) for msg in messages if not isinstance(msg, ToolMessage)
+        )
+
+        contents = {i: str(messages[i].content) for i in tool_positions}
+        read_ranges = [
+            rng for i in tool_positions
+            if (rng := file_read_range(tool_calls.get(messages[i].tool_call_id), contents[i])) is not None
+        ]
+
+        # split tag search results into snippets, dropping ones a file read covers
+        snippets = {}
+        for i in tool_positions:
+            preamble, blocks = split_snippets(contents[i])
+            if not blocks:
+                continue
+            kept = []
+            for path, start, end, block in blocks:
+                if any(path == r_path and r_start <= start and end <= r_end for r_path, r_start, r_end in read_ranges):
+                    usage['deduplicated'] += 1
+                else:
+                    kept.append(block)
+            snippets[i] = (preamble, kept)
+
+        def render(i):
+            if i in snippets:
+                preamble, kept = snippets[i]
+                return preamble + ''.join(kept)
+            return contents[i]
+
+        tool_budget = max(self.budget - usage['system'] - usage['memory'] - usage['conversation'], 0)
+        rendered = {i: render(i) for i in tool_positions}
+        total = sum(count_tokens(text) for text in rendered.values())
+
+        # lowest-ranked snippets first, across all search results
+        while total > tool_budget:
+            candidates = [i for i in snippets if snippets[i][1]]
+            if not candidates:
+                break
+            i = max(candidates, key=lambda i: len(snippets[i][1]))
+            snippets[i][1].pop()
+            usage['trimmed'] += 1
+            total -= count_tokens(rendered[i])
+            rendered[i] = render(i)
+            total += count_tokens(rendered[i])
+
+        # then the tails of the oldest outputs
+        for i in tool_positions:
+            if total <= tool_budget:
+                break
+            text = rendered[i]
+            excess = total - tool_budget
+            keep = max(count_tokens(text) - excess, 64)
+            if keep >= count_tokens(text):
+                continue
+            trimmed = trim_to_tokens(text, keep) + '\n[trimmed to fit the context budget; request a narrower range if needed]'
+            usage['trimmed'] += 1
+            total += count_tokens(trimmed) - count_tokens(text)
+            rendered[i] = trimmed
+
+        packed = list(messages)
+        for i in tool_positions:
+            if rendered[i] != contents[i]:
+                packed[i] = messages[i].model_copy(update={'content': rendered[i]})
+        usage['tools'] = total
+        usage['total'] = usage['system'] + usage['memory'] + usage['conversation'] + usage['tools']
+        return memory_context, packed, usage
+
+
+def format_usage(usage):
+    return (f"context: {usage['total']}/{usage['budget']} tokens (system {usage['system']}, memory {usage['memory']}, "
+            f"conversation {usage['conversation']}, tools {usage['tools']}; "
+            f"{usage['deduplicated']} duplicate snippets dropped, {usage['trimmed']} trims)")
@@ -0,0 +1,320 @@
+import os
+import pickle
+import threading
+
+import numpy as np
+
+DEPGRAPH_FILE = 'depgraph.pkl'
+DEPGRAPH_VERSION = 1
+
+MODULE_SCOPE = (('module', 'Module'),)
+DEFINITION_TYPES = {
+    'function_definition', 'async_function_definition', 'class_definition', 'global_variable_definition',
+}
+
+
+def module_name(file_path, root_dir):
+    rel = os.path.relpath(file_path, root_dir)
+    parts = os.path.splitext(rel)[0].split(os.sep)
+    if parts[-1] == '__init__':
+        parts = parts[:-1]
+    return '.'.join(p for p in parts if p not in ('', '.'))
+
+
+def resolve_relative(target, importer_module, is_package):
+    """
+    '..services.market_data' imported from financial_dashboard.api.endpoints
+    -> 'financial_dashboard.services.market_data'
+    """
+    if not target.startswith('.'):
+        return target
+    level = len(target) - len(target.lstrip('.'))
+    rest = target[level:]
+    base = importer_module.split('.') if importer_module else []
+    if not is_package:
+        base = base[:-1]
+    if level > 1:
+        base = base[:max(len(base) - (level - 1), 0)]
+    return '.'.join(base + ([rest] if rest else []))
+
+
+class FileDeps:
+    """
+    What one file defines and references, extracted from its tags.
+    imports maps each locally bound name to the absolute dotted name it
+    refers to.
+    """
+
+    __slots__ = ('module', 'is_package', 'top_level', 'definitions', 'imports', 'calls')
+
+    def __init__(self, file_path, tags, root_dir):
+        self.module = module_name(file_path, root_dir)
+        self.is_package = os.path.basename(file_path) == '__init__.py'
+        self.top_level = set()
+        self.definitions = set()
+        self.imports = {}
+        self.calls = {}
+
+        for tag in tags:
+            tag_type = tag['type']
+            if tag_type in DEFINITION_TYPES:
+                self.definitions.add(tag['name'])
+                if tag['scope'] == MODULE_SCOPE:
+                    self.top_level.add(tag['name'])
+            elif tag_type == 'import_from_name':
+                self.imports[tag['name']] = resolve_relative(tag['value'], self.module, self.is_package)
+            elif tag_type == 'Import':
+                # `import a.b` binds `a`, `import a.b as c` binds `c`; both
+                # are taken to refer to a.b
+                bound = tag['value'] if tag['value'] != tag['name'] else tag['name'].split('.')[0]
+                self.imports[bound] = tag['name']
+            elif tag_type in ('function_call', 'method_call'):
+                self.calls[tag['name']] = self.calls.get(tag['name'], 0) + 1
+
+    def referenced_names(self):
+        names = set(self.calls)
+        for target in self.imports.values():
+            names.add(target.rsplit('.', 1)[-1])
+        return names
+
+
+class DependencyGraph:
+    """
+    File-level dependency graph built from the code index. Import targets
+    are resolved through relative imports and module paths, and calls
+    through the file's imports or, failing that, a repo-wide definition
+    that is unique. Edges are weighted by reference count.
+
+    update() only recomputes the files that changed and the files that
+    reference names they define; the graph is persisted next to the code
+    index and reused while the index generation matches.
+    """
+
+    def __init__(self, root_dir, index_dir):
+        self.root_dir = root_dir
+        self.path = os.path.join(index_dir, DEPGRAPH_FILE)
+        self.generation = None
+        self.deps = {}
+        self.edges = {}
+        self.modules = {}
+        self.suffixes = {}
+        self.defined_in = {}
+        self.referencers = {}
+        self.lock = threading.RLock()
+
+    @classmethod
+    def load(cls, code_index):
+        graph = cls(code_index.root_dir, code_index.index_dir)
+        if os.path.exists(graph.path):
+            try:
+                with open(graph.path, 'rb') as f:
+                    data = pickle.load(f)
+                if data.get('version') == DEPGRAPH_VERSION and data.get('generation') == code_index.generation:
+                    graph.deps = data['deps']
+                    graph.edges = data['edges']
+                    graph.generation = data['generation']
+                    graph._reindex()
+                    return graph
+            except Exception as e:
+                print(f'[LOG] discarding unreadable dependency graph {graph.path}: {e}')
+        graph.build(code_index)
+        return graph
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        data = {'version': DEPGRAPH_VERSION, 'generation': self.generation, 'deps': self.deps, 'edges': self.edges}
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+
+    def _reindex(self):
+        self.modules = {}
+        self.suffixes = {}
+        self.defined_in = {}
+        self.referencers = {}
+        for file_path, deps in self.deps.items():
+            self._index_file(file_path, deps)
+
+    def _index_file(self, file_path, deps):
+        self.modules[deps.module] = file_path
+        parts = deps.module.split('.')
+        for i in range(len(parts)):
+            self.suffixes.setdefault('.'.join(parts[i:]), set()).add(file_path)
+        for name in deps.definitions:
+            self.defined_in.setdefault(name, set()).add(file_path)
+        for name in deps.referenced_names():
+            self.referencers.setdefault(name, set()).add(file_path)
+
+    def _unindex_file(self, file_path, deps):
+        if self.modules.get(deps.module) == file_path:
+            del self.modules[deps.module]
+        parts = deps.module.split('.')
+        for i in range(len(parts)):
+            self.suffixes.get('.'.join(parts[i:]), set()).discard(file_path)
+        for name in deps.definitions:
+            self.defined_in.get(name, set()).discard(file_path)
+        for name in deps.referenced_names():
+            self.referencers.get(name, set()).discard(file_path)
+
+    def find_module(self, dotted):
+        """
+        File of a dotted module name. Falls back to a unique suffix match, so
+        `services.market_data` still resolves when the index root is above the
+        package root.
+        """
+        if dotted in self.modules:
+            return self.modules[dotted]
+        candidates = self.suffixes.get(dotted)
+        if candidates and len(candidates) == 1:
+            return next(iter(candidates))
+        return None
+
+    def resolve(self, target):
+        """
+        Returns the file that defines an absolute dotted name such as
+        pkg.module or pkg.module.function, or None.
+        """
+        file_path = self.find_module(target)
+        if file_path is None and '.' in target:
+            file_path = self.find_module(target.rsplit('.', 1)[0])
+        return file_path
+
+    def _file_edges(self, file_path):
+        deps = self.deps[file_path]
+        edges = {}
+
+        def add(target_file, weight=1):
+            if target_file and target_file != file_path:
+                edges[target_file] = edges.get(target_file, 0) + weight
+
+        for target in deps.imports.values():
+            add(self.resolve(target))
+
+        for name, count in deps.calls.items():
+            if name in deps.imports:
+                add(self.resolve(deps.imports[name]), count)
+            elif name not in deps.definitions:
+                defined = self.defined_in.get(name)
+                if defined and len(defined) == 1:
+                    add(next(iter(defined)), count)
+        return edges
+
+    def build_from_tags(self, tags_by_file):
+        with self.lock:
+            self.deps = {path: FileDeps(path, tags, self.root_dir) for path, tags in tags_by_file.items()}
+            self._reindex()
+            self.edges = {path: self._file_edges(path) for path in self.deps}
+
+    def build(self, code_index):
+        with self.lock, code_index.lock:
+            self.build_from_tags(code_index.tags)
+            self.generation = code_index.generation
+        self.save()
+
+    def update(self, code_index, changes, generation=None):
+        with self.lock, code_index.lock:
+            changed = set(changes['added']) | set(changes['modified']) | {new for _, new in changes['renamed']}
+            removed = set(changes['removed']) | {old for old, _ in changes['renamed']}
+
+            affected_names = set()
+            for file_path in changed | removed:
+                old = self.deps.pop(file_path, None)
+                if old is not None:
+                    self._unindex_file(file_path, old)
+                    affected_names |= old.definitions | {old.module.rsplit('.', 1)[-1]}
+                self.edges.pop(file_path, None)
+
+            for file_path in changed:
+                if file_path not in code_index.tags:
+                    continue
+                deps = FileDeps(file_path, code_index.tags[file_path], self.root_dir)
+                self.deps[file_path] = deps
+                self._index_file(file_path, deps)
+                affected_names |= deps.definitions | {deps.module.rsplit('.', 1)[-1]}
+
+            affected = {path for path in changed if path in self.deps}
+            for name in affected_names:
+                affected |= self.referencers.get(name, set())
+            for file_path in affected:
+                self.edges[file_path] = self._file_edges(file_path)
+            # a later refresh may already be in the index; its files aren't
+            # in changes, so the graph is only up to date with this one
+            self.generation = code_index.generation if generation is None else generation
+        self.save()
+
+    def sync(self, code_index, changes=None, generation=None):
+        """
+        Brings the graph up to the index generation. changes, from the refresh
+        that produced `generation`, are applied incrementally only when that
+        refresh is the one right after the graph's generation; concurrent
+        refreshes can hand them over out of order, so anything else rebuilds.
+        """
+        with self.lock:
+            if self.generation == code_index.generation:
+                return
+            if changes is None or generation is None or self.generation is None or generation != self.generation + 1:
+                self.build(code_index)
+            else:
+                self.update(code_index, changes, generation)
+
+    def callees(self, file_path):
+        return dict(self.edges.get(file_path, {}))
+
+    def callers(self, file_path):
+        with self.lock:
+            return {source: targets[file_path] for source, targets in self.edges.items() if file_path in targets}
+
+    def personalized_pagerank(self, seeds, alpha=0.85, iters=30, tol=1e-6):
+        """
+        PageRank over the graph with both edge directions (callers and callees
+        are both relevant), restarting at `seeds` ({file: weight}).
+        Returns {file: score}.
+        """
+        with self.lock:
+            files = list(self.deps)
+            pos = {f: i for i, f in enumerate(files)}
+            src, dst, weight = [], [], []
+            for source, targets in self.edges.items():
+                for target, w in targets.items():
+                    if source in pos and target in pos:
+                        src.extend((pos[source], pos[target]))
+                        dst.extend((pos[target], pos[source]))
+                        weight.extend((w, w))
+
+        n = len(files)
+        restart = np.zeros(n)
+        for f, w in seeds.items():
+            if f in pos:
+                restart[pos[f]] += max(w, 0.0)
+        if n == 0 or restart.sum() == 0:
+            return {}
+        restart /= restart.sum()
+
+        src = np.asarray(src, dtype=np.int64)
+        dst = np.asarray(dst, dtype=np.int64)
+        weight = np.asarray(weight, dtype=np.float64)
+        out_weight = np.bincount(src, weights=weight, minlength=n)
+        norm_weight = weight / np.maximum(out_weight[src], 1e-12)
+
+        rank = restart.copy()
+        for _ in range(iters):
+            spread = np.bincount(dst, weights=rank[src] * norm_weight, minlength=n)
+            # mass on files without edges goes back to the seeds
+            dangling = rank[out_weight == 0].sum()
+            new_rank = alpha * (spread + dangling * restart) + (1 - alpha) * restart
+            if np.abs(new_rank - rank).sum() < tol:
+                rank = new_rank
+                break
+            rank = new_rank
+        return {files[i]: float(rank[i]) for i in np.flatnonzero(rank)}
+
+    def to_networkx(self):
+        import networkx as nx
+
+        G = nx.DiGraph()
+        G.add_nodes_from(self.deps)
+        for source, targets in self.edges.items():
+            for target, weight in targets.items():
+                G.add_edge(source, target, weight=weight)
+        return G
@@ -0,0 +1,451 @@
+import hashlib
+import json
+import os
+import queue
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import numpy as np
+
+META_FILE = 'meta.json'
+# vectors and their text hashes, one per line in row order; both are
+# append-only, and a compaction writes a new pair under the next epoch
+VECTORS_FILE = 'vectors-{epoch}.f32'
+HASHES_FILE = 'hashes-{epoch}.txt'
+# the single-file layout written before epochs, migrated on load
+LEGACY_VECTORS_FILE = 'vectors.f32'
+LEGACY_ROWS_FILE = 'rows.json'
+# a sha1 hex digest and a newline
+HASH_LINE_BYTES = 41
+QUANTIZATIONS = ('float32', 'float16', 'int8')
+# rows quantized or scored per numpy call, to bound temporary float32 copies
+CHUNK_ROWS = 65536
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode('UTF-8', errors='replace')).hexdigest()
+
+
+def model_slug(model_name):
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', model_name)
+
+
+def quantize(vectors, quantization):
+    """
+    Returns (codes, scales): float16 codes and no scales, or int8 codes with a
+    per-vector scale so that codes * scale approximates the vector.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if quantization == 'float16':
+        return vectors.astype(np.float16), None
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+
+class EmbeddingStore:
+    """
+    Persistent tag embeddings: a raw float32 matrix on disk plus the text
+    hash of each row. The matrix is memory-mapped on load, and only texts
+    that haven't been seen before are sent to the model. Each embedding model
+    gets its own directory so vectors from different models never mix.
+    New rows are appended to both files, so an add costs O(new rows).
+    compact() drops rows no longer referenced, renumbering the rest; it
+    writes the files of the next epoch and bumps `epoch`, so holders of row
+    numbers can tell theirs went stale.
+
+    With quantization='float16' or 'int8' a compact copy of the matrix is
+    kept in RAM for the first-pass scan in score(); the best candidates are
+    rescored against the float32 rows, which are only paged in from disk
+    when read.
+    """
+
+    def __init__(self, root_dir, model_name, quantization='float32', rescore=300):
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"quantization must be one of {QUANTIZATIONS}, got {quantization!r}")
+        self.model_name = model_name
+        self.quantization = quantization
+        self.rescore = rescore
+        self.store_dir = os.path.join(root_dir, model_slug(model_name))
+        self.meta_path = os.path.join(self.store_dir, META_FILE)
+
+        self.dim = None
+        self.epoch = 0
+        self.rows = {}
+        self.hashes = []
+        self.vectors = None
+        self.codes = None
+        self.scales = None
+        # quantized rows live in the head of these, grown by doubling
+        self._codes_buffer = None
+        self._scales_buffer = None
+        # concurrent tool calls can embed at the same time
+        self.lock = threading.Lock()
+        self._load()
+
+    @property
+    def vectors_path(self):
+        return os.path.join(self.store_dir, VECTORS_FILE.format(epoch=self.epoch))
+
+    @property
+    def hashes_path(self):
+        return os.path.join(self.store_dir, HASHES_FILE.format(epoch=self.epoch))
+
+    def _load(self):
+        if not os.path.exists(self.meta_path):
+            self._migrate()
+        if not os.path.exists(self.meta_path):
+            return
+        try:
+            with open(self.meta_path, 'r', encoding='UTF-8') as f:
+                meta = json.load(f)
+        except Exception as e:
+            print(f'[LOG] discarding unreadable embedding store {self.store_dir}: {e}')
+            return
+        if meta.get('model') != self.model_name or not meta.get('dim'):
+            return
+        self.dim = meta['dim']
+        self.epoch = meta.get('epoch', 0)
+        if not os.path.exists(self.vectors_path) or not os.path.exists(self.hashes_path):
+            return
+
+        with open(self.hashes_path, 'rb') as f:
+            data = f.read()
+        # hashes are appended after their vectors, so only rows with both are
+        # committed; anything past that is an append that never finished
+        count = min(len(data) // HASH_LINE_BYTES, os.path.getsize(self.vectors_path) // (self.dim * 4))
+        self.hashes = data[:count * HASH_LINE_BYTES].decode('ascii').split()
+        self.rows = {digest: row for row, digest in enumerate(self.hashes)}
+        for path, size in ((self.vectors_path, count * self.dim * 4), (self.hashes_path, count * HASH_LINE_BYTES)):
+            if os.path.getsize(path) > size:
+                with open(path, 'r+b') as f:
+                    f.truncate(size)
+        self._map(count)
+
+    def _migrate(self):
+        legacy_rows = os.path.join(self.store_dir, LEGACY_ROWS_FILE)
+        legacy_vectors = os.path.join(self.store_dir, LEGACY_VECTORS_FILE)
+        if not os.path.exists(legacy_rows) or not os.path.exists(legacy_vectors):
+            return
+        try:
+            with open(legacy_rows, 'r', encoding='UTF-8') as f:
+                meta = json.load(f)
+            hashes = sorted(meta['rows'], key=meta['rows'].get)
+            with open(self.hashes_path, 'w', encoding='ascii') as f:
+                f.write(''.join(f'{digest}\n' for digest in hashes))
+            os.replace(legacy_vectors, self.vectors_path)
+            self._save_meta(meta['model'], meta['dim'])
+            os.remove(legacy_rows)
+        except Exception as e:
+            print(f'[LOG] discarding unreadable embedding store {self.store_dir}: {e}')
+
+    def _save_meta(self, model_name=None, dim=None):
+        tmp_path = self.meta_path + '.tmp'
+        with open(tmp_path, 'w', encoding='UTF-8') as f:
+            json.dump({'model': model_name or self.model_name, 'dim': dim or self.dim, 'epoch': self.epoch}, f)
+        os.replace(tmp_path, self.meta_path)
+
+    def _map(self, count):
+        if count == 0:
+            self.vectors = np.zeros((0, self.dim or 0), dtype=np.float32)
+        else:
+            self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(count, self.dim))
+        self._quantize_new_rows()
+
+    def _quantize_new_rows(self):
+        if self.quantization == 'float32':
+            return
+        count = len(self.vectors)
+        done = 0 if self.codes is None else len(self.codes)
+        if self._codes_buffer is None or len(self._codes_buffer) < count:
+            # doubled, so appending n rows one save at a time copies O(n) in total
+            capacity = max(count, 2 * done, 1024)
+            dtype = np.float16 if self.quantization == 'float16' else np.int8
+            codes_buffer = np.empty((capacity, self.dim or 0), dtype=dtype)
+            if done:
+                codes_buffer[:done] = self.codes
+            self._codes_buffer = codes_buffer
+            if self.quantization == 'int8':
+                scales_buffer = np.empty(capacity, dtype=np.float32)
+                if done:
+                    scales_buffer[:done] = self.scales
+                self._scales_buffer = scales_buffer
+        for start in range(done, count, CHUNK_ROWS):
+            end = min(start + CHUNK_ROWS, count)
+            chunk_codes, chunk_scales = quantize(self.vectors[start:end], self.quantization)
+            self._codes_buffer[start:end] = chunk_codes
+            if chunk_scales is not None:
+                self._scales_buffer[start:end] = chunk_scales
+        self.codes = self._codes_buffer[:count]
+        self.scales = self._scales_buffer[:count] if self.quantization == 'int8' else None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, text):
+        return text_hash(text) in self.rows
+
+    def add(self, hashes, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+        os.makedirs(self.store_dir, exist_ok=True)
+        if not os.path.exists(self.meta_path):
+            self._save_meta()
+
+        # vectors first: a row only counts once its hash line is written too
+        with open(self.vectors_path, 'ab') as f:
+            f.write(vectors.tobytes())
+        with open(self.hashes_path, 'a', encoding='ascii') as f:
+            f.write(''.join(f'{digest}\n' for digest in hashes))
+        start = len(self.hashes)
+        for offset, digest in enumerate(hashes):
+            self.rows[digest] = start + offset
+        self.hashes.extend(hashes)
+        self._map(len(self.hashes))
+
+    def compact(self, live_rows):
+        """
+        Keeps only live_rows, renumbered in row order, and returns an array
+        mapping every old row to its new row (-1 if dropped).
+        """
+        with self.lock:
+            live = np.unique(np.asarray(live_rows, dtype=np.int64))
+            mapping = np.full(len(self.hashes), -1, dtype=np.int64)
+            mapping[live] = np.arange(len(live))
+            old_paths = (self.vectors_path, self.hashes_path)
+
+            self.epoch += 1
+            with open(self.vectors_path, 'wb') as f:
+                for start in range(0, len(live), CHUNK_ROWS):
+                    f.write(np.asarray(self.vectors[live[start:start + CHUNK_ROWS]], dtype=np.float32).tobytes())
+            hashes = [self.hashes[row] for row in live.tolist()]
+            with open(self.hashes_path, 'w', encoding='ascii') as f:
+                f.write(''.join(f'{digest}\n' for digest in hashes))
+            # switching to the new epoch is this one atomic replace
+            self._save_meta()
+            for path in old_paths:
+                os.remove(path)
+
+            self.hashes = hashes
+            self.rows = {digest: row for row, digest in enumerate(hashes)}
+            if self.codes is not None:
+                self._codes_buffer = self.codes[live]
+                self._scales_buffer = self.scales[live] if self.scales is not None else None
+                self.codes = self._codes_buffer
+                self.scales = self._scales_buffer
+            self._map(len(hashes))
+            return mapping
+
+    def lookup(self, texts, model, batch_size=64):
+        """
+        Returns the store row of every text, encoding only the texts that
+        aren't in the store yet.
+        """
+        hashes = [text_hash(text) for text in texts]
+
+        with self.lock:
+            missing = {}
+            for digest, text in zip(hashes, texts):
+                if digest not in self.rows and digest not in missing:
+                    missing[digest] = text
+
+            if missing:
+                print(f'[LOG] embedding {len(missing)} new texts with {self.model_name}...')
+                new_vectors = model.encode(list(missing.values()), batch_size=batch_size, normalize_embeddings=True)
+                self.add(list(missing.keys()), new_vectors)
+
+        return np.fromiter((self.rows[digest] for digest in hashes), dtype=np.int64, count=len(hashes))
+
+    def embed(self, texts, model, batch_size=64):
+        """
+        Returns a (len(texts), dim) matrix of normalized embeddings.
+        """
+        rows = self.lookup(texts, model, batch_size=batch_size)
+        if len(rows) == 0:
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+        return self.vectors[rows]
+
+    def _approx_scores(self, rows, q_emb):
+        scores = np.empty(len(rows), dtype=np.float32)
+        for start in range(0, len(rows), CHUNK_ROWS):
+            chunk = rows[start:start + CHUNK_ROWS]
+            chunk_scores = self.codes[chunk].astype(np.float32) @ q_emb
+            if self.scales is not None:
+                chunk_scores *= self.scales[chunk]
+            scores[start:start + CHUNK_ROWS] = chunk_scores
+        return scores
+
+    def score(self, rows, q_emb, rescore=None):
+        """
+        Cosine scores of store rows against a normalized query. Quantized
+        stores scan the compact copy and rescore the `rescore` (default
+        self.rescore) best rows in
+        float32, so their ranking matches exact scoring except for true
+        top hits the first pass ranked below that cutoff.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        q_emb = np.asarray(q_emb, dtype=np.float32)
+        if self.quantization == 'float32' or self.codes is None:
+            return np.asarray(self.vectors[rows], dtype=np.float32) @ q_emb
+
+        scores = self._approx_scores(rows, q_emb)
+        k = min(self.rescore if rescore is None else rescore, len(rows))
+        if k > 0:
+            top = np.argpartition(-scores, k - 1)[:k]
+            # read the float32 rows in file order
+            top = top[np.argsort(rows[top], kind='stable')]
+            scores[top] = np.asarray(self.vectors[rows[top]], dtype=np.float32) @ q_emb
+        return scores
+
+    def memory_report(self):
+        count = len(self.rows)
+        float32_bytes = count * (self.dim or 0) * 4
+        if self.codes is None:
+            resident = float32_bytes
+        else:
+            resident = self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+        return {
+            'rows': count,
+            'dim': self.dim,
+            'quantization': self.quantization,
+            'float32_bytes': float32_bytes,
+            'scan_bytes': resident,
+            'saved': 1 - resident / float32_bytes if float32_bytes else 0.0,
+        }
+
+    def recall_report(self, queries, k=10, rescore=None):
+        """
+        Mean recall@k of quantized scoring, with and without rescoring,
+        against exact float32 scoring over every row, for a (n, dim) matrix
+        of normalized queries.
+        """
+        rows = np.arange(len(self.rows), dtype=np.int64)
+        k = min(k, len(rows))
+        if k == 0:
+            return {'k': k, 'queries': 0, 'recall': 1.0, 'recall_no_rescore': 1.0}
+        recall, recall_no_rescore = [], []
+        for q_emb in np.asarray(queries, dtype=np.float32):
+            exact_scores = np.asarray(self.vectors, dtype=np.float32) @ q_emb
+            exact = set(np.argpartition(-exact_scores, k - 1)[:k])
+            for rescore_k, results in ((rescore, recall), (0, recall_no_rescore)):
+                found = set(np.argpartition(-self.score(rows, q_emb, rescore=rescore_k), k - 1)[:k])
+                results.append(len(found & exact) / k)
+        return {
+            'k': k,
+            'queries': len(recall),
+            'recall': float(np.mean(recall)),
+            'recall_no_rescore': float(np.mean(recall_no_rescore)),
+        }
+
+
+class EmbeddingService:
+    """
+    Drop-in wrapper around a SentenceTransformer that micro-batches small
+    encode requests from all threads: requests are queued and a worker
+    thread flushes them as one model.encode call once max_batch texts are
+    waiting or the oldest has waited max_wait seconds. Requests larger than
+    max_batch (bulk tag embedding) skip the queue. Batch sizes and queueing
+    delays are kept for stats().
+    """
+
+    def __init__(self, model, max_batch=32, max_wait=0.005, history=1000):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        # one model call at a time, whether batched or bulk
+        self._model_lock = threading.Lock()
+        self._batch_sizes = deque(maxlen=history)
+        self._queue_delays = deque(maxlen=history)
+        self._requests = 0
+        self._stats_lock = threading.Lock()
+        self._worker = threading.Thread(target=self._run, name="embed-batcher", daemon=True)
+        self._worker.start()
+
+    def __getattr__(self, name):
+        # everything else (get_sentence_embedding_dimension, ...) is the model's
+        return getattr(self.model, name)
+
+    def submit(self, texts, normalize_embeddings=True):
+        """
+        Queues texts (a string or a list) and returns a Future of their
+        embeddings, shaped like model.encode's result.
+        """
+        future = Future()
+        self._queue.put((texts, normalize_embeddings, time.perf_counter(), future))
+        return future
+
+    def encode(self, texts, batch_size=32, normalize_embeddings=True, **kwargs):
+        count = 1 if isinstance(texts, str) else len(texts)
+        if kwargs or count == 0 or count > self.max_batch:
+            with self._model_lock:
+                return self.model.encode(texts, batch_size=batch_size, normalize_embeddings=normalize_embeddings, **kwargs)
+        return self.submit(texts, normalize_embeddings).result()
+
+    def _collect(self):
+        first = self._queue.get()
+        batch = [first]
+        size = 1 if isinstance(first[0], str) else len(first[0])
+        deadline = first[2] + self.max_wait
+        while size < self.max_batch:
+            # past the deadline, still take whatever queued up meanwhile
+            timeout = deadline - time.perf_counter()
+            try:
+                item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(item)
+            size += 1 if isinstance(item[0], str) else len(item[0])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            for normalize in (True, False):
+                group = [item for item in batch if item[1] == normalize]
+                if group:
+                    self._encode_group(group, normalize)
+
+    def _encode_group(self, group, normalize):
+        texts = []
+        for item_texts, _, _, _ in group:
+            texts.extend([item_texts] if isinstance(item_texts, str) else item_texts)
+        started = time.perf_counter()
+        try:
+            with self._model_lock:
+                vectors = self.model.encode(texts, batch_size=len(texts), normalize_embeddings=normalize)
+        except Exception as e:
+            for _, _, _, future in group:
+                future.set_exception(e)
+            return
+
+        with self._stats_lock:
+            self._batch_sizes.append(len(texts))
+            self._queue_delays.extend(started - queued for _, _, queued, _ in group)
+            self._requests += len(group)
+
+        offset = 0
+        for item_texts, _, _, future in group:
+            if isinstance(item_texts, str):
+                future.set_result(vectors[offset])
+                offset += 1
+            else:
+                future.set_result(vectors[offset:offset + len(item_texts)])
+                offset += len(item_texts)
+
+    def stats(self):
+        with self._stats_lock:
+            sizes = np.asarray(self._batch_sizes, dtype=np.float64)
+            delays = np.asarray(self._queue_delays, dtype=np.float64)
+            return {
+                'requests': self._requests,
+                'batches': len(sizes),
+                'mean_batch': float(sizes.mean()) if len(sizes) else 0.0,
+                'max_batch': int(sizes.max()) if len(sizes) else 0,
+                'queue_p50_ms': float(np.percentile(delays, 50) * 1000) if len(delays) else 0.0,
+                'queue_p95_ms': float(np.percentile(delays, 95) * 1000) if len(delays) else 0.0,
+            }
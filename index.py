@@ -0,0 +1,274 @@
+import hashlib
+import os
+import pickle
+import threading
+import zlib
+
+from parse import parse_files
+from tags import FileTags
+from scanner import Scanner
+from tracing import tracer
+
+INDEX_DIR = '.speak_code'
+# written by INDEX_VERSION 4 and earlier, as one pickle; removed on save
+LEGACY_INDEX_FILE = 'index.pkl'
+INDEX_SHARD_DIR = 'index'
+INDEX_MANIFEST = 'manifest.pkl'
+INDEX_VERSION = 5
+# files are persisted in this many pickles by path, so a refresh only
+# rewrites the shards of the files it changed
+INDEX_SHARDS = 256
+# below this many changed files a process pool costs more than it saves
+PARALLEL_MIN_FILES = 256
+
+
+def content_hash(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def shard_of(file_path):
+    return zlib.crc32(file_path.encode('utf-8', 'surrogateescape')) % INDEX_SHARDS
+
+
+class CodeIndex:
+    """
+    On-disk index of the tags of every .py file under root_dir, along with the
+    mtime/size/hash of each file. refresh() only re-parses files whose metadata
+    changed, so repeated lookups don't re-walk and re-parse the whole repo.
+    Files are found by a Scanner, which skips ignored, huge and generated
+    files. The index is persisted in INDEX_SHARDS pickles plus a manifest;
+    a refresh rewrites only the shards of the files it changed, after
+    releasing the lock.
+    """
+
+    def __init__(self, root_dir=None, workers=None, scanner=None):
+        self.workers = workers or os.cpu_count()
+        self.root_dir = os.path.abspath(root_dir or os.getcwd())
+        self.scanner = scanner or Scanner(self.root_dir)
+        self.index_dir = os.path.join(self.root_dir, INDEX_DIR)
+        self.shard_dir = os.path.join(self.index_dir, INDEX_SHARD_DIR)
+        self.manifest_path = os.path.join(self.shard_dir, INDEX_MANIFEST)
+
+        self.files = {}
+        self.tags = {}
+        # shard number -> file paths persisted in it
+        self.shards = {}
+        self.generation = 0
+        self._all_tags = None
+        # refresh() can run on the watcher thread while a query reads tags
+        self.lock = threading.RLock()
+        # orders concurrent saves, which write outside self.lock
+        self._save_lock = threading.Lock()
+
+    @classmethod
+    def load(cls, root_dir=None, workers=None, scanner=None):
+        index = cls(root_dir, workers=workers, scanner=scanner)
+        if not os.path.exists(index.manifest_path):
+            return index
+        try:
+            with open(index.manifest_path, 'rb') as f:
+                manifest = pickle.load(f)
+        except Exception as e:
+            print(f'[LOG] discarding unreadable index {index.manifest_path}: {e}')
+            return index
+        if manifest.get('version') != INDEX_VERSION or manifest.get('root_dir') != index.root_dir:
+            return index
+        index.generation = manifest.get('generation', 0)
+        for shard in range(INDEX_SHARDS):
+            shard_path = index._shard_path(shard)
+            if not os.path.exists(shard_path):
+                continue
+            # a lost shard only means its files are re-parsed by refresh()
+            try:
+                with open(shard_path, 'rb') as f:
+                    entries = pickle.load(f)
+            except Exception as e:
+                print(f'[LOG] discarding unreadable index shard {shard_path}: {e}')
+                continue
+            for file_path, (meta, tags) in entries.items():
+                index.files[file_path] = meta
+                index.tags[file_path] = tags
+            index.shards[shard] = set(entries)
+        return index
+
+    def _shard_path(self, shard):
+        return os.path.join(self.shard_dir, f'shard-{shard:03d}.pkl')
+
+    def _track(self, file_path, present, dirty):
+        shard = shard_of(file_path)
+        members = self.shards.setdefault(shard, set())
+        if present:
+            members.add(file_path)
+        else:
+            members.discard(file_path)
+        dirty.add(shard)
+
+    def _write(self, path, data):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def save(self, shards=None):
+        """
+        Writes the given shards (all of them by default) and the manifest.
+        Their contents are copied under the lock and pickled outside it.
+        """
+        with self._save_lock:
+            with self.lock:
+                shards = range(INDEX_SHARDS) if shards is None else sorted(shards)
+                payload = {
+                    shard: {path: (dict(self.files[path]), self.tags[path]) for path in self.shards.get(shard, ())}
+                    for shard in shards
+                }
+                manifest = {'version': INDEX_VERSION, 'root_dir': self.root_dir, 'generation': self.generation}
+
+            os.makedirs(self.shard_dir, exist_ok=True)
+            for shard, entries in payload.items():
+                if entries:
+                    self._write(self._shard_path(shard), entries)
+                elif os.path.exists(self._shard_path(shard)):
+                    os.remove(self._shard_path(shard))
+            self._write(self.manifest_path, manifest)
+
+            legacy_path = os.path.join(self.index_dir, LEGACY_INDEX_FILE)
+            if os.path.exists(legacy_path):
+                os.remove(legacy_path)
+
+    def scan(self):
+        """
+        {file_path: (mtime_ns, size)} of every indexable file, with the stat
+        taken from the directory scan.
+        """
+        return dict(self.scanner.scan())
+
+    def walk(self):
+        for file_path, _ in self.scanner.scan():
+            yield file_path
+
+    def _stat(self, file_path):
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def refresh(self, paths=None):
+        """
+        Brings the index up to date with the filesystem. With paths=None the
+        whole tree is re-stat'ed; otherwise only the given paths are checked.
+        Returns (generation, changes): the generation this refresh left the
+        index at and a dict of added/modified/removed/renamed file paths.
+        """
+        with self.lock, tracer.span('refresh', 'index', full=paths is None) as span:
+            changes, dirty = self._refresh(paths)
+            generation = self.generation
+            span.set(**{kind: len(files) for kind, files in changes.items()})
+        if dirty:
+            with tracer.span('index_save', 'index', shards=len(dirty)):
+                self.save(dirty)
+        return generation, changes
+
+    def _refresh(self, paths):
+        """
+        Returns (changes, numbers of the shards that need saving).
+        """
+        changes = {'added': [], 'modified': [], 'removed': [], 'renamed': []}
+        dirty = set()
+
+        if paths is None:
+            current = self.scan()
+            candidates = set(current) | set(self.files)
+        else:
+            candidates = set(os.path.abspath(p) for p in paths if p.endswith('.py'))
+
+        removed = {}
+        added = {}
+        to_parse = []
+        for file_path in sorted(candidates):
+            if paths is None:
+                stat = current.get(file_path)
+            else:
+                # a watched path may have become ignored, too large or generated
+                stat = self._stat(file_path) if self.scanner.includes(file_path) else None
+            if stat is None:
+                if file_path in self.files:
+                    removed.setdefault(self.files[file_path]['hash'], []).append(file_path)
+                continue
+
+            meta = self.files.get(file_path)
+            if meta and (meta['mtime'], meta['size']) == stat:
+                continue
+
+            try:
+                with open(file_path, 'rb') as f:
+                    data = f.read()
+            except OSError:
+                continue
+            digest = content_hash(data)
+
+            if meta and meta['hash'] == digest:
+                meta['mtime'], meta['size'] = stat
+                dirty.add(shard_of(file_path))
+                continue
+
+            self.files[file_path] = {'mtime': stat[0], 'size': stat[1], 'hash': digest}
+            self._track(file_path, True, dirty)
+            if meta:
+                changes['modified'].append(file_path)
+                to_parse.append(file_path)
+            else:
+                added[file_path] = digest
+
+        for file_path, digest in added.items():
+            old_path = removed[digest].pop() if removed.get(digest) else None
+            if old_path is not None:
+                self.tags[file_path] = self.tags.pop(old_path).moved(file_path)
+                del self.files[old_path]
+                self._track(old_path, False, dirty)
+                changes['renamed'].append((old_path, file_path))
+            else:
+                to_parse.append(file_path)
+                changes['added'].append(file_path)
+
+        if to_parse:
+            workers = self.workers if len(to_parse) >= PARALLEL_MIN_FILES else None
+            parsed = parse_files(to_parse, workers=workers)
+            for file_path in to_parse:
+                self.tags[file_path] = parsed.get(file_path) or FileTags(file_path, '')
+
+        for old_path in [p for group in removed.values() for p in group]:
+            self.files.pop(old_path, None)
+            self.tags.pop(old_path, None)
+            self._track(old_path, False, dirty)
+            changes['removed'].append(old_path)
+
+        if any(changes.values()):
+            self.generation += 1
+            self._all_tags = None
+        if not os.path.exists(self.manifest_path):
+            return changes, set(range(INDEX_SHARDS))
+        return changes, dirty
+
+    def snapshot(self):
+        """
+        (generation, {file_path: FileTags}) as of one moment. A file's
+        FileTags is replaced whenever the file is re-parsed or renamed, so
+        derived indexes can tell changed files apart by identity.
+        """
+        with self.lock:
+            return self.generation, dict(self.tags)
+
+    def tag_snapshot(self):
+        """
+        (generation, all_tags()) read together, for queries that index into
+        all_tags with positions from derived indexes of that generation.
+        """
+        with self.lock:
+            return self.generation, self.all_tags()
+
+    def all_tags(self):
+        with self.lock:
+            if self._all_tags is None:
+                self._all_tags = [tag for file_path in sorted(self.tags) for tag in self.tags[file_path]]
+            return self._all_tags
@@ -0,0 +1,233 @@
+import math
+import os
+import re
+import threading
+from collections import Counter
+
+import numpy as np
+
+from tags import StaleIndexError
+
+WORD_RE = re.compile(r'[A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z_][A-Za-z0-9_]*)*')
+CAMEL_RE = re.compile(r'[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|[0-9]+')
+# looks like code rather than prose: snake_case, CamelCase or dotted
+IDENTIFIER_RE = re.compile(r'^(?:\w+_\w+|[A-Z][a-z0-9]+[A-Z]\w*|\w+(?:\.\w+)+)$')
+
+STOPWORDS = {
+    'a', 'an', 'the', 'is', 'are', 'was', 'be', 'of', 'to', 'in', 'on', 'for', 'and', 'or', 'with', 'by',
+    'where', 'what', 'how', 'which', 'who', 'does', 'do', 'it', 'this', 'that', 'i', 'me', 'my', 'find',
+    'show', 'defined', 'define', 'code', 'file', 'function', 'class', 'method', 'called', 'used', 'get',
+}
+
+DEFINITION_TYPES = {'function_definition', 'async_function_definition', 'class_definition'}
+
+
+def split_identifier(identifier):
+    """
+    'Database.get_user' -> ['database', 'get', 'user'],
+    'calculatePortfolioValue' -> ['calculate', 'portfolio', 'value']
+    """
+    parts = []
+    for chunk in re.split(r'[._\W]+', identifier):
+        parts.extend(p.lower() for p in CAMEL_RE.findall(chunk))
+    return parts
+
+
+def tokenize_query(query):
+    terms = []
+    for word in WORD_RE.findall(query):
+        lowered = word.lower()
+        if lowered in STOPWORDS:
+            continue
+        terms.append(lowered)
+        terms.extend(t for t in split_identifier(word) if t not in STOPWORDS and t != lowered)
+    return terms
+
+
+def tag_terms(tag):
+    name = tag['name']
+    terms = [name.lower()]
+    name_parts = split_identifier(name)
+    # name tokens count twice: they matter more than where the tag lives
+    terms.extend(name_parts)
+    terms.extend(name_parts)
+    for scope_name, scope_type in tag['scope']:
+        if scope_type == 'ClassDef':
+            terms.append(f"{scope_name}.{name}".lower())
+            terms.extend(split_identifier(scope_name))
+    terms.extend(split_identifier(os.path.splitext(os.path.basename(tag['file_path']))[0]))
+    if tag['value']:
+        terms.extend(split_identifier(str(tag['value'])))
+    return terms
+
+
+class LexicalIndex:
+    """
+    Inverted index over tag names, enclosing classes, file names and split
+    identifiers, scored with BM25. Exact identifier lookups
+    (`calculate_portfolio_value`, `Database.get_user`) are answered from a
+    name map without scoring.
+
+    Postings are kept per file with positions local to the file, so when the
+    code index generation changes sync() only re-indexes the files whose
+    FileTags changed; global tag positions are the file's offset in
+    all_tags() plus the local position.
+    """
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.generation = None
+        # term -> {file_path: (local positions, term frequencies)}
+        self.postings = {}
+        # lowercased name or Class.name -> {file_path: [local positions]}
+        self.names = {}
+        # file_path -> (FileTags, terms, names, doc lengths)
+        self.files = {}
+        self.offsets = {}
+        self.doc_lengths = np.zeros(0, dtype=np.float32)
+        self.avg_length = 0.0
+        # term -> (global positions, tfs), merged lazily for this generation
+        self._merged = {}
+        self.lock = threading.Lock()
+
+    def sync(self, code_index):
+        with self.lock:
+            if self.generation == code_index.generation:
+                return
+            generation, tables = code_index.snapshot()
+            for file_path in [p for p, entry in self.files.items() if tables.get(p) is not entry[0]]:
+                self._unindex_file(file_path)
+            for file_path, table in tables.items():
+                if file_path not in self.files:
+                    self._index_file(file_path, table)
+
+            offsets = {}
+            offset = 0
+            for file_path in sorted(tables):
+                offsets[file_path] = offset
+                offset += len(tables[file_path])
+            lengths = [self.files[file_path][3] for file_path in offsets]
+            self.offsets = offsets
+            self.doc_lengths = np.concatenate(lengths) if lengths else np.zeros(0, dtype=np.float32)
+            self.avg_length = float(self.doc_lengths.mean()) if len(self.doc_lengths) else 0.0
+            self._merged = {}
+            self.generation = generation
+
+    def _index_file(self, file_path, table):
+        postings = {}
+        names = {}
+        lengths = np.zeros(len(table), dtype=np.float32)
+        for pos, tag in enumerate(table):
+            terms = tag_terms(tag)
+            lengths[pos] = len(terms)
+            for term, tf in Counter(terms).items():
+                postings.setdefault(term, ([], []))
+                postings[term][0].append(pos)
+                postings[term][1].append(tf)
+            names.setdefault(tag['name'].lower(), []).append(pos)
+            for scope_name, scope_type in tag['scope']:
+                if scope_type == 'ClassDef':
+                    names.setdefault(f"{scope_name}.{tag['name']}".lower(), []).append(pos)
+
+        for term, (positions, tfs) in postings.items():
+            self.postings.setdefault(term, {})[file_path] = (
+                np.asarray(positions, dtype=np.int64), np.asarray(tfs, dtype=np.float32))
+        for name, positions in names.items():
+            self.names.setdefault(name, {})[file_path] = positions
+        self.files[file_path] = (table, list(postings), list(names), lengths)
+
+    def _unindex_file(self, file_path):
+        _, terms, names, _ = self.files.pop(file_path)
+        for term in terms:
+            by_file = self.postings[term]
+            del by_file[file_path]
+            if not by_file:
+                del self.postings[term]
+        for name in names:
+            by_file = self.names[name]
+            del by_file[file_path]
+            if not by_file:
+                del self.names[name]
+
+    def _term_postings(self, term):
+        entry = self._merged.get(term)
+        if entry is None:
+            by_file = self.postings.get(term)
+            if not by_file:
+                return None
+            positions = np.concatenate([local + self.offsets[f] for f, (local, _) in by_file.items()])
+            tfs = np.concatenate([tfs for _, tfs in by_file.values()])
+            entry = self._merged[term] = (positions, tfs)
+        return entry
+
+    def _name_positions(self, name):
+        by_file = self.names.get(name)
+        if not by_file:
+            return []
+        return [self.offsets[f] + pos for f, positions in by_file.items() for pos in positions]
+
+    def _check(self, generation):
+        if generation is not None and generation != self.generation:
+            raise StaleIndexError(f'lexical index is at generation {self.generation}, tags at {generation}')
+
+    def exact_matches(self, query, all_tags, generation=None):
+        """
+        Tag positions whose name (or Class.name) is exactly an identifier in
+        the query, definitions first. Only identifier-looking words count, so
+        prose like "portfolio" doesn't short-circuit semantic search.
+        With a generation, raises StaleIndexError unless the index is synced
+        to it.
+        """
+        matches = []
+        with self.lock:
+            self._check(generation)
+            for word in WORD_RE.findall(query.replace('`', ' ')):
+                if not IDENTIFIER_RE.match(word):
+                    continue
+                positions = self._name_positions(word.lower())
+                if not positions and '.' in word:
+                    positions = self._name_positions(word.rsplit('.', 1)[1].lower())
+                matches.extend(positions)
+        return sorted(set(matches), key=lambda pos: (all_tags[pos]['type'] not in DEFINITION_TYPES, pos))
+
+    def search(self, query, k=200, generation=None):
+        """
+        Returns (tag positions, BM25 scores) of the k best tags. With a
+        generation, raises StaleIndexError unless the index is synced to it.
+        """
+        with self.lock:
+            self._check(generation)
+            return self._search(query, k)
+
+    def _search(self, query, k):
+        n = len(self.doc_lengths)
+        scores = np.zeros(n, dtype=np.float32)
+        for term in set(tokenize_query(query)):
+            entry = self._term_postings(term)
+            if entry is None:
+                continue
+            positions, tfs = entry
+            idf = math.log(1 + (n - len(positions) + 0.5) / (len(positions) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[positions] / max(self.avg_length, 1e-6))
+            # positions are unique within one posting list
+            scores[positions] += idf * tfs * (self.k1 + 1) / (tfs + norm)
+
+        hit = np.flatnonzero(scores)
+        if len(hit) == 0:
+            return hit, np.zeros(0, dtype=np.float32)
+        k = min(k, len(hit))
+        top = hit[np.argpartition(-scores[hit], k - 1)[:k]]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return top, scores[top]
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """
+    Fuses several ranked lists of ids into one {id: score} map.
+    """
+    fused = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking):
+            fused[item] = fused.get(item, 0.0) + 1.0 / (k + rank + 1)
+    return fused
@@ -1,10 +1,26 @@
 from langchain_core.messages import ToolMessage, HumanMessage, AIMessage
+import copy
+import json
+import os
 import re
-from langchain_core.prompts import ChatPromptTemplate
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+import numpy as np
 from langchain_core.output_parsers import JsonOutputParser
-from langchain_core.pydantic_v1 import BaseModel, Field
+from pydantic import BaseModel, Field
 
-from prompts import KEY_FINDINGS_PROMPT
+from prompts import MEMORY_UPDATE_PROMPT
+from tracing import tracer, token_usage
+
+MEMORY_STORE_FILE = 'memory.json'
+# finding vectors, kept out of the JSON so recall-count updates don't rewrite them
+MEMORY_VECTORS_FILE = 'memory_vectors.npz'
+# findings about the repo itself; every other type stays with its session
+SHARED_FINDING_TYPES = ('ai_conclusion',)
+# characters kept per message in conversation_history
+HISTORY_CHARS = 300
 
 def initialize_memory():
     return {
@@ -12,29 +28,63 @@ def initialize_memory():
         "key_findings": [],
     }
 
-def update_memory(state, llm, explicit_update=None):
+class MemoryUpdate(BaseModel):
+    context: str | None = Field(default=None, description="User's working context if mentioned")
+    findings: list[dict] | None = Field(default=None, description="Any explicit findings or notes")
+    key_findings: list[str] | None = Field(default=None, description="Key findings about files or code")
+
+def extract_memory_update(messages, llm):
+    """
+    Single LLM call that extracts both the explicit findings (user notes, AI
+    conclusions) and the short key-finding summaries from the recent messages.
+    """
+    recent_messages = messages[-3:]
+    conversation = "\n".join([f"{msg.type.upper()}: {msg.content}" for msg in recent_messages])
 
-    memory = state.get('memory', initialize_memory().copy())
+    parser = JsonOutputParser(pydantic_object=MemoryUpdate)
+    prompt = MEMORY_UPDATE_PROMPT.format(conversation=conversation)
+    with tracer.span('memory_update', 'llm') as span:
+        response = llm.invoke([HumanMessage(content=prompt)])
+        prompt_tokens, response_tokens = token_usage(response, (len(prompt) + 3) // 4)
+        span.set(prompt_tokens=prompt_tokens, response_tokens=response_tokens)
+    try:
+        updates = parser.invoke(response)
+    except Exception as e:
+        print(f"[LOG] could not parse memory update: {e}")
+        return {}
 
-    if explicit_update:
-        if 'findings' in explicit_update:
-            memory['key_findings'].extend(explicit_update['findings'])
-    
-    recent_msgs = state['messages'][-10:]
-    memory['conversation_history'] = [x.content for x in recent_msgs]
-    
-    ai_messages = [msg.content for msg in recent_msgs if isinstance(msg, AIMessage)]
-    key_findings_prompt = KEY_FINDINGS_PROMPT.format(ai_messages=" | ".join(ai_messages))
+    if hasattr(updates, 'dict'):
+        return updates.dict(exclude_none=True)
+    return updates or {}
+
+def update_memory(state, llm, store=None, session=None):
 
-    findings = llm.invoke([HumanMessage(content=key_findings_prompt)])
-    if hasattr(findings, 'content'):
-        formatted_finding = {"type": "ai_summary", "content": findings.content}
-        memory['key_findings'].append(formatted_finding)
+    memory = copy.deepcopy(state.get('memory') or initialize_memory())
+    updates = extract_memory_update(state['messages'], llm)
+
+    new_findings = [f for f in updates.get('findings') or [] if isinstance(f, dict) and f.get('content')]
+    for finding in updates.get('key_findings') or []:
+        new_findings.append({"type": "ai_summary", "content": finding})
+    memory['key_findings'].extend(new_findings)
+    if updates.get('context'):
+        memory['context'] = updates['context']
+    if store is not None and new_findings:
+        store.add(new_findings, session=session)
+
+    # questions and answers only; tool output is what made prompts balloon
+    recent_msgs = [msg for msg in state['messages'] if isinstance(msg, HumanMessage) or (isinstance(msg, AIMessage) and not msg.tool_calls)]
+    history = memory['conversation_history'] + [str(msg.content)[:HISTORY_CHARS] for msg in recent_msgs if msg.content]
+    memory['conversation_history'] = history[-10:]
     memory['key_findings'] = memory['key_findings'][-10:]
 
     return memory
 
-def get_memory_context(memory):
+def get_memory_context(memory, store=None, query=None, k=5, max_chars=1200, session=None):
+    """
+    With a FindingStore and a query, only the k stored findings most
+    relevant to the query (among those visible to session) are included,
+    within max_chars; otherwise the session's recent findings are.
+    """
     if not memory:
         return ''
     
@@ -42,42 +92,290 @@ def get_memory_context(memory):
     
     context.append('History: ' + '\n'.join(memory['conversation_history']))
     
-    if memory.get('key_findings'):
+    if store is not None and query:
+        relevant = store.recall(query, k=k, max_chars=max_chars, session=session)
+        if relevant:
+            context.append("Relevant findings: " + "; ".join(f["content"] for f in relevant))
+    elif memory.get('key_findings'):
         recent_findings = memory['key_findings']
         findings_text = "; ".join([f["content"][:100] for f in recent_findings])
         context.append(f"Recent findings: {findings_text}")
 
     return " | ".join(context) if context else ""
 
-class MemoryUpdate(BaseModel):
-    context: str | None = Field(default=None, description="User's working context if mentioned")
-    findings: list[dict] | None = Field(default=None, description="Any explicit findings or notes")
+class FindingStore:
+    """
+    Long-term memory: findings embedded once when added, persisted next to
+    the code index and shared across sessions. Entries are JSON and their
+    vectors a binary .npz keyed by entry id, so the vectors are only
+    rewritten when findings are added or evicted. recall() returns the
+    findings most similar to a query; a finding's retention score is
+    (1 + times recalled) halved every half_life_days since it was last
+    recalled, and the lowest-scoring findings are evicted past max_findings.
+    Near-duplicates of an existing finding refresh it instead of being added.
+    Findings record the session that added them; only SHARED_FINDING_TYPES
+    are recalled in other sessions, so one user's notes don't reach another
+    user's prompts. recall() only marks the store dirty; flush() (called
+    from the background memory thread) or the next add() writes the updated
+    counts.
+    """
 
-def update_memory_node(state, llm):
-    recent_messages = state["messages"][-3:]
-    conversation = "\n".join([f"{msg.type.upper()}: {msg.content}" for msg in recent_messages])
+    def __init__(self, index_dir, embed, model_name, max_findings=1000, half_life_days=14.0,
+                 min_score=0.3, duplicate_threshold=0.95):
+        self.path = os.path.join(index_dir, MEMORY_STORE_FILE)
+        self.vectors_path = os.path.join(index_dir, MEMORY_VECTORS_FILE)
+        self.embed = embed
+        self.model_name = model_name
+        self.max_findings = max_findings
+        self.half_life = half_life_days * 86400
+        self.min_score = min_score
+        self.duplicate_threshold = duplicate_threshold
 
-    extractor_prompt = ChatPromptTemplate.from_messages([
-    ("system", """You are a memory extraction assistant. 
-    Analyze the recent conversation and extract structured updates.
+        self.entries = []
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+        self._last_query = None
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._load()
 
-    - If the user explicitly asks you to remember something, add it to 'findings' as type 'user_note'.
-    - If the assistant states conclusions, issues, or results, add them to 'findings' as type 'ai_conclusion'.
-    Return ONLY valid JSON.
-    """),
-    ("human", "Conversation:\n{conversation}")
-    ])
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='UTF-8') as f:
+                data = json.load(f)
+            # vectors from another embedding model can't be compared
+            if data.get('model') != self.model_name or not data.get('entries'):
+                return
+            entries = data['entries']
+            if all('vector' in entry for entry in entries):
+                # written before vectors moved to their own file
+                vectors = np.asarray([entry.pop('vector') for entry in entries], dtype=np.float32)
+            else:
+                with np.load(self.vectors_path) as stored:
+                    rows = {id_: i for i, id_ in enumerate(stored['ids'].tolist())}
+                    # an entry whose vector write didn't land is dropped
+                    entries = [entry for entry in entries if entry['id'] in rows]
+                    vectors = stored['vectors'][[rows[entry['id']] for entry in entries]]
+        except Exception as e:
+            print(f'[LOG] discarding unreadable memory store {self.path}: {e}')
+            return
+        self.entries = entries
+        self.vectors = np.asarray(vectors, dtype=np.float32).reshape(len(entries), -1)
 
-    parser = JsonOutputParser(pydantic_object=MemoryUpdate)
-    
-    # Run extractor LLM
-    chain = extractor_prompt | llm | parser
-    explicit_updates = chain.invoke({"conversation": conversation})
+    def _save_vectors(self):
+        os.makedirs(os.path.dirname(self.vectors_path), exist_ok=True)
+        tmp_path = self.vectors_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, ids=np.asarray([entry['id'] for entry in self.entries], dtype=str), vectors=self.vectors)
+        os.replace(tmp_path, self.vectors_path)
+
+    def _save_entries(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='UTF-8') as f:
+            json.dump({'model': self.model_name, 'entries': self.entries}, f)
+        os.replace(tmp_path, self.path)
+        self._dirty = False
+
+    def save(self):
+        with self._lock:
+            self._save_vectors()
+            self._save_entries()
+
+    def flush(self):
+        """
+        Writes recall counts updated since the last save, if any.
+        """
+        with self._lock:
+            if self._dirty:
+                self._save_entries()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _retention(self, now):
+        uses = np.asarray([entry['uses'] for entry in self.entries], dtype=np.float64)
+        age = now - np.asarray([entry['last_used'] for entry in self.entries], dtype=np.float64)
+        return (1 + uses) * 0.5 ** (age / self.half_life)
+
+    def _visible(self, session):
+        return np.asarray([entry['type'] in SHARED_FINDING_TYPES or entry.get('session') == session
+                           for entry in self.entries], dtype=bool)
+
+    def add(self, findings, session=None):
+        findings = [f for f in findings if f.get('content')]
+        if not findings:
+            return
+        vectors = np.asarray(self.embed([f['content'] for f in findings]), dtype=np.float32).reshape(len(findings), -1)
+        now = time.time()
+        with self._lock:
+            count = len(self.entries)
+            for finding, vector in zip(findings, vectors):
+                if len(self.entries):
+                    # a duplicate of a finding this session can't see is added as its own
+                    scores = np.where(self._visible(session), self.vectors @ vector, -np.inf)
+                    best = int(np.argmax(scores))
+                    if scores[best] >= self.duplicate_threshold:
+                        self.entries[best]['last_used'] = now
+                        continue
+                self.entries.append({
+                    'id': uuid.uuid4().hex,
+                    'type': finding.get('type', 'finding'),
+                    'content': finding['content'],
+                    'created': now,
+                    'last_used': now,
+                    'uses': 0,
+                    'session': session,
+                })
+                vector = vector.reshape(1, -1)
+                self.vectors = vector if self.vectors.size == 0 else np.vstack([self.vectors, vector])
+            added = len(self.entries) > count
+
+            if len(self.entries) > self.max_findings:
+                # ties (e.g. never recalled) go to the newer finding
+                created = np.asarray([entry['created'] for entry in self.entries])
+                keep = np.sort(np.lexsort((-created, -self._retention(now)))[:self.max_findings])
+                self.entries = [self.entries[i] for i in keep]
+                self.vectors = self.vectors[keep]
+            # vectors first: entries without a stored vector are dropped on load
+            if added:
+                self._save_vectors()
+            self._save_entries()
+
+    def recall(self, query, k=5, max_chars=1200, session=None):
+        """
+        Up to k findings visible to session and relevant to query
+        (cosine >= min_score), best first, with their contents totalling at
+        most max_chars.
+        """
+        with self._lock:
+            if not self.entries:
+                return []
+        q_emb = np.asarray(self.embed([query]), dtype=np.float32).reshape(-1)
+        with self._lock:
+            scores = np.where(self._visible(session), self.vectors @ q_emb, -np.inf)
+            found, used = [], 0
+            for i in np.argsort(-scores, kind='stable')[:k]:
+                if scores[i] < self.min_score:
+                    break
+                content = self.entries[i]['content']
+                if used + len(content) > max_chars:
+                    continue
+                found.append(i)
+                used += len(content)
+
+            # call_model recalls for every step of a turn; count a use once per query
+            if (session, query) != self._last_query and found:
+                now = time.time()
+                for i in found:
+                    self.entries[i]['uses'] += 1
+                    self.entries[i]['last_used'] = now
+                self._dirty = True
+            self._last_query = (session, query)
+            return [dict(self.entries[i], score=float(scores[i])) for i in found]
+
+    def clear(self):
+        with self._lock:
+            self.entries = []
+            self.vectors = np.zeros((0, 0), dtype=np.float32)
+            self._last_query = None
+            self._save_vectors()
+            self._save_entries()
+
+    def forget(self, session):
+        """
+        Drops every finding session added, shared types included.
+        """
+        with self._lock:
+            keep = [i for i, entry in enumerate(self.entries) if entry.get('session') != session]
+            if len(keep) == len(self.entries):
+                return
+            self.entries = [self.entries[i] for i in keep]
+            self.vectors = self.vectors[keep]
+            self._last_query = None
+            self._save_vectors()
+            self._save_entries()
+
+class BackgroundMemory:
+    """
+    Runs memory updates on a background thread after a turn's answer has been
+    returned, so the update's LLM call isn't part of turn latency. Updates are
+    applied in submission order; current() returns the latest memory that is
+    ready, or waits for pending updates with wait=True.
+
+    Several sessions can share one bounded `executor`; each session's updates
+    still apply in order.
+    """
+
+    def __init__(self, get_llm, memory=None, executor=None, get_store=None, session=None):
+        self.get_llm = get_llm
+        # long-term FindingStore, looked up lazily since it loads in the background
+        self.get_store = get_store or (lambda: None)
+        # owner of the findings this memory adds to the store
+        self.session = session
+        self.memory = memory or initialize_memory()
+        self._executor = executor or ThreadPoolExecutor(max_workers=1, thread_name_prefix="memory")
+        self._future = None
+        self._lock = threading.Lock()
+
+    def _update(self, messages, previous=None):
+        if previous is not None:
+            # submitted earlier to the same FIFO pool, so already running or next
+            wait([previous])
+        with self._lock:
+            memory = self.memory
+        try:
+            store = self.get_store()
+            new_memory = update_memory({"messages": messages, "memory": memory}, self.get_llm(), store,
+                                       session=self.session)
+            if store is not None:
+                # recall counts from the turn just answered
+                store.flush()
+        except Exception as e:
+            print(f"[LOG] memory update failed: {e}")
+            return
+        with self._lock:
+            # a clear() while this update ran wins
+            if self.memory is memory:
+                self.memory = new_memory
+
+    def submit(self, messages):
+        previous = self._future if self.pending() else None
+        self._future = self._executor.submit(self._update, list(messages), previous)
+        return self._future
+
+    def pending(self):
+        return self._future is not None and not self._future.done()
+
+    def current(self, wait=False):
+        if wait and self._future is not None:
+            self._future.result()
+        with self._lock:
+            return self.memory
 
-    if hasattr(explicit_updates, 'dict'):
-        updates_dict = explicit_updates.dict(exclude_none=True)
-    else:
-        updates_dict = explicit_updates
+    def _forget(self, previous=None):
+        if previous is not None:
+            wait([previous])
+        try:
+            store = self.get_store()
+            if store is None:
+                return
+            # the REPL (session None) is the store's only user
+            if self.session is None:
+                store.clear()
+            else:
+                store.forget(self.session)
+        except Exception as e:
+            print(f"[LOG] clearing long-term findings failed: {e}")
 
-    updated_memory = update_memory(state, llm, explicit_update=updates_dict) 
-    return {"memory": updated_memory}
\ No newline at end of file
+    def clear(self):
+        """
+        Resets this memory and drops its long-term findings; the store is
+        cleared after any update still adding to it.
+        """
+        with self._lock:
+            self.memory = initialize_memory()
+        previous = self._future if self.pending() else None
+        self._future = self._executor.submit(self._forget, previous)
+        return self._future
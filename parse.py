@@ -1,65 +1,155 @@
 import ast 
+import io
+import multiprocessing
 import os
+import tokenize
 import numpy as np
-import networkx as nx
-import matplotlib.pyplot as plt
-from sentence_transformers import SentenceTransformer
-from tqdm import tqdm
 import json
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 from functools import lru_cache
 
-
-
-def parse_codebase(root_dir=None):
+from tags import FileTags
+from scanner import Scanner
+from lexical import reciprocal_rank_fusion
+
+
+
+def read_source(file_path):
+    """
+    Decodes a source file using its PEP 263 coding cookie (UTF-8 by
+    default). Undecodable bytes are replaced instead of failing the file.
+    """
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    try:
+        encoding, _ = tokenize.detect_encoding(io.BytesIO(data).readline)
+    except SyntaxError:
+        encoding = 'utf-8'
+    try:
+        return data.decode(encoding)
+    except (UnicodeDecodeError, LookupError):
+        print(f'[LOG] {file_path} is not valid {encoding}, replacing undecodable bytes')
+        return data.decode('utf-8', errors='replace')
+
+def parse_file(file_path, code=None):
+    if code is None:
+        try:
+            code = read_source(file_path)
+        except OSError as e:
+            print(f'[LOG] skipping {file_path}: {e}')
+            return [], None
+    try:
+        tree = ast.parse(code)
+    except Exception as e:
+        print(f'[LOG] skipping {file_path}: {e}')
+        return [], None
+
+    visitor = FileVisitor(file_path, code)
+    visitor.visit(tree)
+    return visitor.tags, tree
+
+def _parse_chunk(file_paths):
+    # runs in a worker process; ASTs stay behind, only the column-backed
+    # FileTags tables are pickled back to the parent
+    results = []
+    for file_path in file_paths:
+        tags, tree = parse_file(file_path)
+        results.append((file_path, tags if tree is not None else None))
+    return results
+
+def pool_context():
+    # forking a process that already runs the watcher, warmup and embedding
+    # threads (and has torch loaded) can deadlock the children
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+def in_pool_bootstrap():
+    """
+    True while multiprocessing re-imports the main module into a pool worker
+    or the forkserver, where module-level startup work must not run.
+    """
+    return getattr(multiprocessing.current_process(), '_inheriting', False)
+
+def parse_files(file_paths, workers=None, chunk_size=64, file_asts=None):
+    """
+    Parses file_paths and returns {file_path: tags} for the files that parsed,
+    in sorted path order. With workers > 1 the files are parsed in chunks on a
+    process pool; otherwise ASTs are also collected into file_asts if given.
+    """
+    file_paths = sorted(file_paths)
+    parsed = {}
+
+    start = time.perf_counter()
+    if workers and workers > 1 and len(file_paths) > chunk_size:
+        chunks = [file_paths[i:i + chunk_size] for i in range(0, len(file_paths), chunk_size)]
+        with ProcessPoolExecutor(max_workers=workers, mp_context=pool_context()) as pool:
+            for results in pool.map(_parse_chunk, chunks):
+                for file_path, tags in results:
+                    if tags is not None:
+                        parsed[file_path] = tags
+    else:
+        for file_path in file_paths:
+            tags, tree = parse_file(file_path)
+            if tree is not None:
+                parsed[file_path] = tags
+                if file_asts is not None:
+                    file_asts[file_path] = tree
+    elapsed = time.perf_counter() - start
+
+    if file_paths:
+        rate = len(file_paths) / elapsed if elapsed > 0 else float('inf')
+        print(f'[LOG] parsed {len(file_paths)} files in {elapsed:.2f}s ({rate:.0f} files/sec, workers={workers or 1})')
+    return parsed
+
+def parse_codebase(root_dir=None, workers=None, scanner=None):
 
     if not root_dir:
         root_dir = os.getcwd()
 
     print(f'[LOG] root dir: {root_dir}')
 
-    all_tags = []
+    # skips .git, virtualenvs, __pycache__, .gitignore'd, huge and generated files
+    scanner = scanner or Scanner(root_dir)
+    file_paths = [file_path for file_path, _ in scanner.scan()]
+
+    # ASTs can't cheaply cross process boundaries, so they are only returned
+    # from a serial parse
     file_asts = {}
-    for root, _, files in os.walk(root_dir):
-        for file in files:
-            if file.endswith('.py'):
-                file_path = os.path.join(root, file)
-                with open(file_path, 'r') as f:
-                    code = f.read()
-                    codelines = code.splitlines(keepends=True)
-                    try:
-                        tree = ast.parse(code)
-                    except Exception as e:
-                        print(e)
-
-                file_asts[file_path] = tree
-                visitor = FileVisitor(file_path, codelines)
-                visitor.visit(tree)
-                all_tags.extend(visitor.tags)
+    parsed = parse_files(file_paths, workers=workers, file_asts=file_asts)
+    all_tags = [tag for file_path in parsed for tag in parsed[file_path]]
     return all_tags, file_asts
 
+def dotted_name(node):
+    parts = []
+    while isinstance(node, ast.Attribute):
+        parts.append(node.attr)
+        node = node.value
+    if not isinstance(node, ast.Name):
+        return None
+    parts.append(node.id)
+    return '.'.join(reversed(parts))
+
 class FileVisitor(ast.NodeVisitor):
-    def __init__(self, file_path, full_code_lines):
+    def __init__(self, file_path, source):
         self.file_path = file_path
-        self.full_code_lines = full_code_lines
-        self.tags = []
+        self.tags = FileTags(file_path, source)
 
         self.scope_stack = [('module', 'Module')]
 
     def get_source_code(self, node):
-        startline = node.lineno - 1
-        endline = getattr(node, "end_lineno", node.lineno)
-        return ''.join(self.full_code_lines[startline:endline])
+        return self.tags.text(node.lineno, getattr(node, "end_lineno", node.lineno))
 
     def _add_tag(self, name, tag_type, node, value=None):
-        self.tags.append({
-            'file_path': self.file_path,
-            'name': name,
-            'type': tag_type,
-            'lines': self.get_source_code(node), 
-            'scope': self.scope_stack,
-            'value': value
-        })
+        self.tags.add(
+            name,
+            tag_type,
+            node.lineno,
+            getattr(node, "end_lineno", node.lineno) or node.lineno,
+            tuple(self.scope_stack),
+            value,
+        )
 
     def _extract_names_from_target(self, target_node):
         names = []
@@ -108,91 +198,192 @@ class FileVisitor(ast.NodeVisitor):
         self.generic_visit(node)
 
     def visit_ImportFrom(self, node):
-        module_name = node.module if node.module else '.'
+        # tag name is the locally bound name, value the full target with its
+        # relative-import dots kept, e.g. `from ..services import market_data`
+        # -> value '..services.market_data'
+        prefix = '.' * (node.level or 0) + (f"{node.module}." if node.module else '')
         for alias in node.names:
-            self._add_tag(alias.name, 'import_from_name', node, value=f"{module_name}.{alias.asname or alias.name}")
+            self._add_tag(alias.asname or alias.name, 'import_from_name', node, value=f"{prefix}{alias.name}")
         self.generic_visit(node)
 
     def visit_Call(self, node):
         if isinstance(node.func, ast.Name):
             self._add_tag(node.func.id, 'function_call', node)
         elif isinstance(node.func, ast.Attribute):
-            self._add_tag(node.func.attr, 'method_call', node)
+            # value is the dotted receiver, e.g. 'market_data' for
+            # market_data.get_market_overview(), so calls through an imported
+            # module or a class can be resolved; None for computed receivers
+            self._add_tag(node.func.attr, 'method_call', node, value=dotted_name(node.func.value))
         self.generic_visit(node)
 
 
-def build_dependency_graph(all_tags):
-    G = nx.DiGraph()
+def build_dependency_graph(all_tags, root_dir=None):
+    from depgraph import DependencyGraph
 
-    all_definitions_map = {}
+    tags_by_file = {}
     for tag in all_tags:
-        if 'definition' in tag['type'] or 'import' in tag['type']:
-            name = tag['value'] if tag['value'] else tag['name']
-            all_definitions_map[name] = tag['file_path']
-    
-    unique_files = set(tag['file_path'] for tag in all_tags)
-    for file in unique_files:
-        G.add_node(file)
+        tags_by_file.setdefault(tag['file_path'], []).append(tag)
+    if not root_dir:
+        root_dir = os.path.commonpath(list(tags_by_file)) if tags_by_file else os.getcwd()
 
-    for tag in all_tags:
-        if 'call' in tag['type'] or 'import' in tag['type']:
-            source_file = tag['file_path']
-            referenced_name = tag['name']
-
-            if 'import' in tag['type'] and tag['value']:
-                referenced_name = tag['value']
-            
-            if referenced_name in all_definitions_map:
-                target_file = all_definitions_map[referenced_name]
-
-                if source_file != target_file:
-                    G.add_edge(source_file, target_file)
-    
-    return G
+    # index_dir is unused since this graph is never saved
+    graph = DependencyGraph(root_dir, root_dir)
+    graph.build_from_tags(tags_by_file)
+    return graph.to_networkx()
 
 @lru_cache(maxsize=4096)
 def embed_text(text, model):
     return model.encode(text, normalize_embeddings=True)
 
-def weights_for_query(query, all_tags, model):
-
-    q_emb = embed_text(query, model)
-    weights = {}
-    tag_weights = {}
-    tag_counts = {}
-
-    for tag in tqdm(all_tags):
-        key = tag['file_path']
-        if key not in weights:
-            weights[key] = 0.0
-            tag_counts[key] = 0
-    
-        text = f"File {tag['file_path']} contains {tag['type']} named {tag['name']} with code: {tag['lines']}"
-        sim = np.dot(q_emb, embed_text(text, model))
-        tag_weights[tag['name']] = (sim, text)
-        weights[key] += sim
-        tag_counts[key] += 1
-    
-    for f in weights:
-        if tag_counts[f] > 0:
-            weights[f] /= tag_counts[f]
-
-    ranked_files = sorted(weights.items(), key=lambda item: item[1], reverse=True)[:5]
-    ranked_tags = sorted(tag_weights.items(), key=lambda item: item[1][0], reverse=True)[:5]
-
-    return ranked_files, ranked_tags
+def tag_text(tag):
+    return f"File {tag['file_path']} contains {tag['type']} named {tag['name']} with code: {tag['lines']}"
+
+def top_k(scores, k):
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    idx = np.argpartition(-scores, k - 1)[:k]
+    return idx[np.argsort(-scores[idx], kind='stable')]
+
+def semantic_scores(query, all_tags, model, store=None, batch_size=256, ann=None, ann_candidates=200, generation=None):
+    """
+    Returns (tag positions, cosine scores). With an ann (TagANN) that has
+    been built only the ann_candidates nearest tags are returned, otherwise
+    every tag is scored. An ann synced with all_tags also supplies the store
+    row of every tag, so tag texts aren't rebuilt and hashed per query; pass
+    the generation of all_tags to have it checked.
+    """
+    q_emb = np.asarray(embed_text(query, model), dtype=np.float32)
+
+    if ann is not None:
+        return ann.search(q_emb, k=ann_candidates, generation=generation)
+
+    tag_texts = [tag_text(tag) for tag in all_tags]
+    if store is not None:
+        # quantized stores rescore their best first-pass candidates in float32
+        rows = store.lookup(tag_texts, model, batch_size=batch_size)
+        return np.arange(len(all_tags)), store.score(rows, q_emb)
+    else:
+        tag_embs = model.encode(tag_texts, batch_size=batch_size, normalize_embeddings=True)
+    return np.arange(len(all_tags)), np.asarray(tag_embs, dtype=np.float32) @ q_emb
+
+def rank_files(all_tags, positions, scores, top_n, reduce='mean'):
+    if len(positions) == 0:
+        return []
+    files, file_ids = np.unique([all_tags[i]['file_path'] for i in positions], return_inverse=True)
+    if reduce == 'mean':
+        file_scores = np.bincount(file_ids, weights=scores) / np.bincount(file_ids)
+    else:
+        file_scores = np.full(len(files), -np.inf)
+        np.maximum.at(file_scores, file_ids, scores)
+    return [(str(files[i]), float(file_scores[i])) for i in top_k(file_scores, top_n)]
+
+def rank_tags(all_tags, positions, scores, top_n):
+    # over-fetch so that repeated names (e.g. many calls to the same function)
+    # still leave top_n distinct tags
+    ranked_tags = []
+    seen = set()
+    for i in top_k(np.asarray(scores, dtype=np.float32), top_n * 8):
+        tag = all_tags[positions[i]]
+        if tag['name'] in seen:
+            continue
+        seen.add(tag['name'])
+        location = (tag['file_path'], tag['start_line'], tag['end_line'])
+        ranked_tags.append((tag['name'], (float(scores[i]), tag_text(tag), location)))
+        if len(ranked_tags) == top_n:
+            break
+    return ranked_tags
+
+def graph_rerank(ranked_files, graph, top_n):
+    """
+    Fuses a file ranking with personalized PageRank over the dependency
+    graph, seeded by that ranking, so the callers/callees of the best hits
+    move up.
+    """
+    if graph is None or not ranked_files:
+        return ranked_files[:top_n]
+    seeds = {f: max(score, 0.0) + 1e-6 for f, score in ranked_files}
+    pagerank = graph.personalized_pagerank(seeds)
+    graph_files = sorted(pagerank, key=pagerank.get, reverse=True)[:len(ranked_files) * 2]
+    fused = reciprocal_rank_fusion([[f for f, _ in ranked_files], graph_files])
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)[:top_n]
+
+def exact_ranking(query, all_tags, lexical, graph=None, top_n=5, generation=None):
+    """
+    (ranked files, ranked tags) for a query that names an existing identifier
+    exactly, from the lexical index alone; None otherwise, in which case the
+    query needs semantic search.
+    """
+    if not all_tags:
+        return [], []
+    exact = lexical.exact_matches(query, all_tags, generation=generation)
+    if not exact:
+        return None
+    positions = np.asarray(exact, dtype=np.int64)
+    # already ordered definitions first
+    scores = np.linspace(1.0, 0.5, len(positions), dtype=np.float32)
+    ranked_files = rank_files(all_tags, positions, scores, top_n * 2, reduce='max')
+    return graph_rerank(ranked_files, graph, top_n), rank_tags(all_tags, positions, scores, top_n)
+
+def weights_for_query(query, all_tags, model, store=None, top_n=5, batch_size=256, ann=None, ann_candidates=200, lexical=None, graph=None, generation=None):
+    """
+    Ranks files by their mean tag similarity to the query and returns the top
+    files and top distinct tags.
+
+    With a lexical index (LexicalIndex, synced with all_tags), a query that
+    names an existing identifier exactly is answered from the lexical index
+    alone without touching the embedding model; otherwise BM25 and embedding
+    rankings are combined with reciprocal rank fusion. With a dependency graph
+    (DependencyGraph) the file ranking is re-ranked by personalized PageRank.
+
+    With the code index generation all_tags was read at, the lexical index
+    and ann raise StaleIndexError if they were synced to another one.
+    """
+    if not all_tags:
+        return [], []
+
+    if lexical is not None:
+        exact = exact_ranking(query, all_tags, lexical, graph, top_n, generation)
+        if exact is not None:
+            return exact
+
+    sem_positions, sem_scores = semantic_scores(
+        query, all_tags, model, store=store, batch_size=batch_size, ann=ann,
+        ann_candidates=max(ann_candidates, top_n * 8), generation=generation,
+    )
+    if lexical is not None:
+        lex_positions, lex_scores = lexical.search(query, k=ann_candidates, generation=generation)
+    else:
+        lex_positions, lex_scores = [], []
+    if len(lex_positions) == 0:
+        ranked_files = rank_files(all_tags, sem_positions, sem_scores, top_n * 2)
+        return graph_rerank(ranked_files, graph, top_n), rank_tags(all_tags, sem_positions, sem_scores, top_n)
+
+    sem_top = sem_positions[top_k(sem_scores, ann_candidates)]
+    fused = reciprocal_rank_fusion([sem_top.tolist(), lex_positions.tolist()])
+    positions = np.fromiter(fused.keys(), dtype=np.int64, count=len(fused))
+    scores = np.fromiter(fused.values(), dtype=np.float32, count=len(fused))
+
+    sem_files = [f for f, _ in rank_files(all_tags, sem_positions, sem_scores, len(all_tags))]
+    lex_files = [f for f, _ in rank_files(all_tags, lex_positions, lex_scores, len(all_tags), reduce='max')]
+    fused_files = reciprocal_rank_fusion([sem_files, lex_files])
+    ranked_files = sorted(fused_files.items(), key=lambda item: item[1], reverse=True)[:top_n * 2]
+
+    return graph_rerank(ranked_files, graph, top_n), rank_tags(all_tags, positions, scores, top_n)
 
 if __name__ == '__main__':
     all_tags, file_ast = parse_codebase()
     G = build_dependency_graph(all_tags)
     print('[LOG]DiGraph created...')
 
+    # import matplotlib.pyplot as plt
     # nx.draw(G, with_labels=True, node_color='lightblue', arrows=True)
     # plt.show()
 
     query='I want to add a new database connection'
 
     print('[LOG] loading model...')
+    from sentence_transformers import SentenceTransformer
     model = SentenceTransformer("nomic-ai/nomic-embed-text-v1", trust_remote_code=True)
     print('[LOG] loaded model...')
     ranked_files, ranked_tags = weights_for_query(query, all_tags, model)
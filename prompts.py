@@ -1,7 +1,16 @@
-KEY_FINDINGS_PROMPT = '''
-    Decide whether the following message has any key findings we can use. 
-    A key finding can be any relevant info on a file or code. 
-    Summarize them in under 150 chars each, separated by a newline chara.: {ai_messages}
+MEMORY_UPDATE_PROMPT = '''
+    You are a memory extraction assistant. Analyze the recent conversation and extract structured updates.
+
+    - If the user explicitly asks you to remember something, add it to 'findings' as type 'user_note'.
+    - If the assistant states conclusions, issues, or results, add them to 'findings' as type 'ai_conclusion'.
+    - Put any key findings about specific files or code in 'key_findings', each summarized in under 150 chars.
+    - If the user mentions what they are working on, put it in 'context'.
+
+    Return ONLY valid JSON of the form:
+    {{"context": "<string or null>", "findings": [{{"type": "...", "content": "..."}}], "key_findings": ["..."]}}
+
+    Conversation:
+    {conversation}
     '''
 
 
@@ -0,0 +1,136 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class IndexedFile:
+    """
+    Open descriptor of one file plus the byte offset of each line start, so
+    a line range is a single pread. Unlike an mmap slice, a pread of a file
+    an editor truncated since it was indexed is just a short read, not a
+    SIGBUS.
+    """
+
+    def __init__(self, file_path):
+        self.path = file_path
+        self.fd = os.open(file_path, os.O_RDONLY)
+        try:
+            stat = os.fstat(self.fd)
+            data = os.pread(self.fd, stat.st_size, 0)
+        except OSError:
+            os.close(self.fd)
+            raise
+        self.key = (stat.st_mtime_ns, stat.st_size)
+        self.size = len(data)
+        newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord('\n')) if self.size else np.zeros(0, dtype=np.int64)
+        starts = np.concatenate([[0], newlines + 1])
+        # a trailing newline doesn't start another line
+        if len(starts) > 1 and starts[-1] == self.size:
+            starts = starts[:-1]
+        self.line_starts = starts.astype(np.int64)
+
+    @property
+    def line_count(self):
+        return len(self.line_starts) if self.size else 0
+
+    def offset(self, line):
+        """
+        Byte offset of the start of 1-based `line`; line_count + 1 is EOF.
+        """
+        if line > self.line_count:
+            return self.size
+        return int(self.line_starts[line - 1])
+
+    def line_at(self, offset):
+        """
+        1-based line containing byte `offset`.
+        """
+        return int(np.searchsorted(self.line_starts, offset, side='right'))
+
+    def read(self, start, end):
+        return os.pread(self.fd, end - start, start) if end > start else b''
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FileReader:
+    """
+    Serves file reads from an LRU of line-indexed open files, reindexed when
+    a file's mtime or size changes. Reads can be limited to a line range and
+    are capped at max_bytes, cut after the last whole line that fits; a
+    capped read ends with a marker naming the lines to request next. A
+    first line longer than max_bytes is returned whole up to max_line_bytes
+    (default 4 * max_bytes) and cut there.
+    """
+
+    def __init__(self, max_bytes=24000, max_open=64, max_line_bytes=None):
+        self.max_bytes = max_bytes
+        self.max_line_bytes = max_line_bytes or 4 * max_bytes
+        self.max_open = max_open
+        self.files = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _opened(self, file_path):
+        # called with self.lock held, so no read is using a descriptor this closes
+        file_path = os.path.abspath(file_path)
+        stat = os.stat(file_path)
+        cached = self.files.get(file_path)
+        if cached is not None and cached.key == (stat.st_mtime_ns, stat.st_size):
+            self.files.move_to_end(file_path)
+            return cached
+        if cached is not None:
+            del self.files[file_path]
+            cached.close()
+        indexed = IndexedFile(file_path)
+        self.files[file_path] = indexed
+        while len(self.files) > self.max_open:
+            self.files.popitem(last=False)[1].close()
+        return indexed
+
+    def read(self, file_path, start_line=None, end_line=None, max_bytes=None):
+        max_bytes = max_bytes or self.max_bytes
+        with self.lock:
+            indexed = self._opened(file_path)
+            total = indexed.line_count
+            start_line = max(int(start_line or 1), 1)
+            end_line = min(int(end_line or total), total)
+            if total == 0:
+                return ''
+            if start_line > end_line:
+                return f"Error: line {start_line} is outside the file ({total} lines)"
+
+            start = indexed.offset(start_line)
+            end = indexed.offset(end_line + 1)
+            last_line = end_line
+            truncated = end - start > max_bytes
+            if truncated:
+                # the last whole line that fits
+                last_line = indexed.line_at(start + max_bytes) - 1
+                if last_line >= start_line:
+                    end = indexed.offset(last_line + 1)
+                else:
+                    # the first line alone doesn't fit: send it up to max_line_bytes
+                    last_line = start_line
+                    end = min(indexed.offset(start_line + 1), start + max(self.max_line_bytes, max_bytes))
+            data = indexed.read(start, end)
+            line_cut = end < indexed.offset(last_line + 1)
+            last_line_bytes = indexed.offset(last_line + 1) - indexed.offset(last_line)
+        content = data.decode('UTF-8', errors='replace')
+
+        header = ''
+        if start_line > 1 or end_line < total or truncated:
+            header = f"[lines {start_line}-{last_line} of {total}]\n"
+        if line_cut:
+            content += f"\n[line {last_line} cut at {end - indexed.offset(last_line)} of {last_line_bytes} bytes]"
+        if truncated and last_line < end_line:
+            content += f"\n[truncated, request lines {last_line + 1}-{end_line}]"
+        return header + content
+
+    def close(self):
+        with self.lock:
+            for indexed in self.files.values():
+                indexed.close()
+            self.files.clear()
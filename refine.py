@@ -0,0 +1,95 @@
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+
+GREETINGS = {
+    'hi', 'hello', 'hey', 'yo', 'thanks', 'thank you', 'thx', 'ok', 'okay', 'cool', 'great', 'bye',
+    'good morning', 'good evening', 'good afternoon', 'how are you', 'whats up', 'sup', 'nice',
+}
+
+# a path with an extension, e.g. financial_dashboard/main.py or README.md
+PATH_RE = re.compile(r'[\w./\\-]*\w\.(py|md|txt|json|toml|yaml|yml|cfg|ini|js|ts|html|css|sh)\b')
+# snake_case, CamelCase or dotted identifiers, e.g. get_stock_price, Database.get_user
+IDENTIFIER_RE = re.compile(r'\b([a-z_][a-z0-9]*_[a-z0-9_]+|[A-Z][a-z0-9]+[A-Z]\w*|\w+\.\w+\(?\)?)\b')
+COMMAND_RE = re.compile(r'^(read|open|show|cat|list|ls|print|display|find|where is|what is in|whats in)\b')
+
+
+def normalize_query(query):
+    query = re.sub(r'\s+', ' ', query.strip().lower())
+    return query.rstrip('?!. ')
+
+
+def classify_query(query):
+    """
+    Cheap local check run before the refine_query LLM call. Returns
+    'trivial' for greetings and small talk, 'specific' for queries that
+    already name a file or identifier alongside a direct command, and
+    'refine' for everything else.
+    """
+    normalized = normalize_query(query)
+    words = re.sub(r'[^\w\s]', '', normalized)
+    if not words or words in GREETINGS or (len(words.split()) <= 2 and words.split()[0] in GREETINGS):
+        return 'trivial'
+    if PATH_RE.search(query) and (COMMAND_RE.match(normalized) or len(normalized.split()) <= 4):
+        return 'specific'
+    if IDENTIFIER_RE.search(query) and COMMAND_RE.match(normalized):
+        return 'specific'
+    return 'refine'
+
+
+def context_fingerprint(memory_context):
+    return hashlib.sha1(memory_context.encode('UTF-8', errors='replace')).hexdigest()[:16]
+
+
+class RefineCache:
+    """
+    LRU cache of refined queries keyed by (normalized query, memory context
+    fingerprint), with counters for hits, misses and skipped refinements.
+    """
+
+    def __init__(self, max_size=512):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+        self._lock = threading.Lock()
+
+    def _key(self, query, memory_context):
+        return normalize_query(query), context_fingerprint(memory_context)
+
+    def get(self, query, memory_context):
+        key = self._key(query, memory_context)
+        with self._lock:
+            refined = self.entries.get(key)
+            if refined is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return refined
+
+    def put(self, query, memory_context, refined):
+        key = self._key(query, memory_context)
+        with self._lock:
+            self.entries[key] = refined
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def record_skip(self):
+        with self._lock:
+            self.skipped += 1
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses + self.skipped
+            return {
+                'queries': total,
+                'skipped': self.skipped,
+                'hits': self.hits,
+                'misses': self.misses,
+                'llm_calls_saved': (self.hits + self.skipped) / total if total else 0.0,
+                'size': len(self.entries),
+            }
@@ -0,0 +1,244 @@
+"""
+Serves the agent over HTTP so several developers share one process: one
+compiled graph, one embedding model, one code index and its retrieval
+state, with per-session memory.
+
+    python server.py            # or: uvicorn server:app
+
+Turns run on a pool of SERVER_WORKERS threads. At most SERVER_WORKERS +
+SERVER_QUEUE turns are admitted at once; past that the server answers 503
+with Retry-After instead of queueing without bound.
+"""
+import asyncio
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse
+from langchain_core.messages import AIMessage, HumanMessage
+from pydantic import BaseModel
+
+import agent
+from memory import BackgroundMemory
+from tracing import tracer
+
+SERVER_WORKERS = int(os.environ.get("SERVER_WORKERS", 4))
+SERVER_QUEUE = int(os.environ.get("SERVER_QUEUE", 16))
+SERVER_MAX_SESSIONS = int(os.environ.get("SERVER_MAX_SESSIONS", 256))
+# idle sessions are dropped after this many seconds
+SERVER_SESSION_TTL = float(os.environ.get("SERVER_SESSION_TTL", 3600))
+MEMORY_WORKERS = int(os.environ.get("MEMORY_WORKERS", 2))
+
+
+class Session:
+
+    def __init__(self, session_id, memory_executor):
+        self.id = session_id
+        # sessions share the store, but only recall each other's ai_conclusion findings
+        self.memory = BackgroundMemory(agent.get_llm, executor=memory_executor, get_store=agent.get_memory_store,
+                                       session=session_id)
+        # one turn at a time per session, so memory updates stay ordered
+        self.lock = asyncio.Lock()
+        self.created = time.time()
+        self.last_used = self.created
+        self.turns = 0
+
+
+class SessionStore:
+    """
+    Per-session state, bounded to max_sessions with idle sessions expiring
+    after ttl seconds. Memory updates from all sessions share one bounded
+    thread pool.
+    """
+
+    def __init__(self, max_sessions, ttl, memory_workers):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.sessions = {}
+        self.memory_executor = ThreadPoolExecutor(max_workers=memory_workers, thread_name_prefix="memory")
+        self._lock = threading.Lock()
+
+    def _expire(self):
+        now = time.time()
+        for session_id in [s.id for s in self.sessions.values() if now - s.last_used > self.ttl and not s.lock.locked()]:
+            del self.sessions[session_id]
+
+    def create(self):
+        with self._lock:
+            self._expire()
+            if len(self.sessions) >= self.max_sessions:
+                return None
+            session = Session(uuid.uuid4().hex, self.memory_executor)
+            self.sessions[session.id] = session
+            return session
+
+    def get(self, session_id):
+        with self._lock:
+            session = self.sessions.get(session_id)
+            if session is not None:
+                session.last_used = time.time()
+            return session
+
+    def delete(self, session_id):
+        with self._lock:
+            return self.sessions.pop(session_id, None) is not None
+
+    def __len__(self):
+        return len(self.sessions)
+
+
+class Admission:
+    """
+    Counts admitted turns; try_acquire() fails instead of blocking once
+    `limit` turns are running or queued.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        with self._lock:
+            if self.active >= self.limit:
+                self.rejected += 1
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.active -= 1
+
+
+class QueryRequest(BaseModel):
+    query: str
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # keeps the shared index current for every session
+    agent.warmup.submit("index_watcher", agent.start_index_watcher)
+    yield
+
+
+app = FastAPI(title="speak-code", lifespan=lifespan)
+sessions = SessionStore(SERVER_MAX_SESSIONS, SERVER_SESSION_TTL, MEMORY_WORKERS)
+admission = Admission(SERVER_WORKERS + SERVER_QUEUE)
+turn_executor = ThreadPoolExecutor(max_workers=SERVER_WORKERS, thread_name_prefix="turn")
+
+
+def run_turn(session, query):
+    with tracer.span('turn', 'server', session=session.id):
+        q_emb, cached = agent.cached_answer(query)
+        if cached is not None:
+            return {"answer": cached['answer'], "cached": True, "tools": []}
+
+        initial_state = {
+            "messages": [HumanMessage(content=query)],
+            "memory": session.memory.current(wait=agent.WAIT_FOR_MEMORY),
+            "session": session.id,
+        }
+        result = agent.graph.invoke(initial_state)
+        agent.remember_answer(query, q_emb, result['messages'])
+        session.memory.submit(result['messages'])
+
+    final_messages = [msg for msg in result['messages'] if isinstance(msg, AIMessage)]
+    tools = [tool_call['name'] for msg in final_messages for tool_call in msg.tool_calls or []]
+    answer = final_messages[-1].content if final_messages else ""
+    return {"answer": answer, "cached": False, "tools": tools}
+
+
+def busy():
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Server is at capacity, retry shortly"},
+        headers={"Retry-After": "2"},
+    )
+
+
+@app.post("/sessions")
+def create_session():
+    session = sessions.create()
+    if session is None:
+        raise HTTPException(status_code=503, detail="Too many sessions")
+    return {"session_id": session.id}
+
+
+@app.delete("/sessions/{session_id}")
+def delete_session(session_id: str):
+    if not sessions.delete(session_id):
+        raise HTTPException(status_code=404, detail="Unknown session")
+    return {"deleted": session_id}
+
+
+@app.post("/sessions/{session_id}/query")
+async def query(session_id: str, request: QueryRequest):
+    session = sessions.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Unknown session")
+    if not admission.try_acquire():
+        return busy()
+    try:
+        async with session.lock:
+            start = time.perf_counter()
+            loop = asyncio.get_running_loop()
+            response = await loop.run_in_executor(turn_executor, run_turn, session, request.query)
+            session.turns += 1
+            response["elapsed"] = time.perf_counter() - start
+            return response
+    finally:
+        admission.release()
+
+
+@app.get("/sessions/{session_id}/memory")
+def get_memory(session_id: str):
+    session = sessions.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Unknown session")
+    memory = session.memory.current()
+    return {
+        "pending": session.memory.pending(),
+        "conversation_history": memory.get('conversation_history', []),
+        "key_findings": memory.get('key_findings', []),
+    }
+
+
+@app.post("/sessions/{session_id}/clear")
+def clear_memory(session_id: str):
+    session = sessions.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Unknown session")
+    session.memory.clear()
+    return {"cleared": session_id}
+
+
+@app.get("/health")
+def health():
+    ready = {name: agent.warmup.loaded(name) for name in ("code_index", "indexes", "llm", "embed_model", "retrieval")}
+    return {"ready": all(ready.values()), "components": ready}
+
+
+@app.get("/stats")
+def stats():
+    return {
+        "sessions": len(sessions),
+        "active_turns": admission.active,
+        "rejected_turns": admission.rejected,
+        "capacity": admission.limit,
+        "refine_query": agent.refine_cache.stats(),
+        "embeddings": agent.get_embed_model().stats() if agent.warmup.loaded("embed_model") else None,
+        "answer_cache": agent.get_answer_cache().stats() if agent.ANSWER_CACHE else None,
+        "stages": tracer.summary(),
+    }
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    uvicorn.run(app, host=os.environ.get("SERVER_HOST", "127.0.0.1"), port=int(os.environ.get("SERVER_PORT", 8000)))
@@ -0,0 +1,61 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+
+class Warmup:
+    """
+    Runs the expensive pieces of agent startup (index load, embedding model,
+    LLM client) on a background thread, in submission order, so the REPL
+    prompt can appear right away. get(name) blocks until that piece is ready.
+    Every phase, foreground or background, is timed for report().
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.timings = {}
+        self._futures = {}
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='warmup')
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = time.perf_counter() - start
+
+    def record(self, name, seconds):
+        self.timings[name] = seconds
+
+    def _timed(self, name, fn):
+        with self.phase(name):
+            return fn()
+
+    def submit(self, name, fn):
+        self._futures[name] = self._executor.submit(self._timed, name, fn)
+        return self._futures[name]
+
+    def get(self, name):
+        return self._futures[name].result()
+
+    def ready(self, name):
+        future = self._futures.get(name)
+        return future is not None and future.done()
+
+    def loaded(self, name):
+        """
+        True once name finished without an error.
+        """
+        return self.ready(name) and self._futures[name].exception() is None
+
+    def report(self):
+        lines = ['Startup phases:']
+        for name, seconds in self.timings.items():
+            lines.append(f'  {name:<16} {seconds * 1000:8.1f} ms')
+        for name, future in self._futures.items():
+            if not future.done():
+                lines.append(f'  {name:<16}  (still loading)')
+            elif future.exception() is not None:
+                lines.append(f'  {name:<16}  failed: {future.exception()}')
+        return '\n'.join(lines)
@@ -0,0 +1,287 @@
+import threading
+
+from depgraph import MODULE_SCOPE, module_name
+
+DEFINITION_TYPES = {'function_definition', 'async_function_definition', 'class_definition', 'global_variable_definition', 'class_attribute_definition'}
+# definitions of these types carry their own name as the innermost scope
+SCOPED_DEFINITION_TYPES = {'function_definition', 'async_function_definition', 'class_definition'}
+CALL_TYPES = {'function_call', 'method_call'}
+IMPORT_TYPES = {'import_from_name', 'Import'}
+
+
+def scope_path(scope):
+    return [name for name, scope_type in scope if scope_type != 'Module']
+
+
+def owner_scope(tag):
+    """
+    Scope the tag's name is bound in: for functions and classes the tag's
+    scope ends with the definition itself, which is dropped.
+    """
+    scope = tag['scope']
+    return scope[:-1] if tag['type'] in SCOPED_DEFINITION_TYPES else scope
+
+
+class FileSymbols:
+    """
+    What one file contributes to the symbol table: its definitions, and its
+    resolved references, ambiguous method calls and the short names those
+    refer to (so the file is re-resolved when their definitions change).
+    """
+
+    __slots__ = ('table', 'module', 'definitions', 'top_level', 'references', 'unresolved', 'referenced')
+
+    def __init__(self, table, module):
+        self.table = table
+        self.module = module
+        self.definitions = []
+        self.top_level = set()
+        self.references = []
+        self.unresolved = []
+        self.referenced = set()
+
+
+class SymbolTable:
+    """
+    Precomputed symbol table over the code index: qualified name ->
+    definition sites, and qualified name -> call/import references, with
+    imports resolved through relative imports via the dependency graph's
+    module map. Every dotted suffix of a qualified name is also indexed, so
+    `get_user`, `Database.get_user` and `db.database.Database.get_user` are
+    all single dict lookups.
+
+    When the code index generation changes, sync() only re-indexes the files
+    whose FileTags changed, and re-resolves the references of files that
+    refer to a name whose definitions changed, like DependencyGraph.update.
+    """
+
+    def __init__(self):
+        self.generation = None
+        self.files = {}
+        self.definitions = {}
+        # qualified name -> {file_path: [reference sites]}
+        self.references = {}
+        self.suffixes = {}
+        # method calls whose receiver type is unknown: name -> {file_path: [sites]}
+        self.unresolved = {}
+        # short name -> files whose references mention it
+        self.referencers = {}
+        self.lock = threading.Lock()
+
+    def sync(self, code_index, graph):
+        with self.lock:
+            if self.generation == code_index.generation:
+                return
+            generation, tables = code_index.snapshot()
+            with graph.lock:
+                self._update(tables, code_index.root_dir, graph)
+            self.generation = generation
+
+    def _update(self, tables, root_dir, graph):
+        changed = [path for path, table in tables.items() if path not in self.files or self.files[path].table is not table]
+        removed = [path for path in self.files if path not in tables]
+
+        affected_names = set()
+        for file_path in changed + removed:
+            if file_path in self.files:
+                affected_names |= self._unindex_file(file_path)
+        for file_path in changed:
+            affected_names |= self._index_definitions(file_path, tables[file_path], root_dir)
+
+        affected = set(changed)
+        for name in affected_names:
+            affected |= self.referencers.get(name, set())
+        for file_path in affected:
+            entry = self.files[file_path]
+            self._unindex_references(file_path, entry)
+            self._index_references(file_path, entry, graph)
+
+    def _index_definitions(self, file_path, table, root_dir):
+        module = module_name(file_path, root_dir)
+        entry = self.files[file_path] = FileSymbols(table, module)
+        module_parts = [p for p in module.split('.') if p]
+        if module_parts:
+            entry.definitions.append((module, (file_path, 1, None, 'module')))
+        for tag in table:
+            if tag['type'] not in DEFINITION_TYPES:
+                continue
+            scope = owner_scope(tag)
+            qualified = '.'.join(p for p in module.split('.') + scope_path(scope) + [tag['name']] if p)
+            entry.definitions.append((qualified, (file_path, tag.start_line, tag.end_line, tag['type'])))
+            if scope == MODULE_SCOPE:
+                entry.top_level.add(tag['name'])
+
+        for qualified, site in entry.definitions:
+            if qualified not in self.definitions:
+                self.definitions[qualified] = []
+                parts = qualified.split('.')
+                for i in range(len(parts)):
+                    self.suffixes.setdefault('.'.join(parts[i:]), set()).add(qualified)
+            self.definitions[qualified].append(site)
+        return {qualified.rsplit('.', 1)[-1] for qualified, _ in entry.definitions}
+
+    def _unindex_file(self, file_path):
+        entry = self.files.pop(file_path)
+        self._unindex_references(file_path, entry)
+        for qualified, site in entry.definitions:
+            sites = self.definitions[qualified]
+            sites.remove(site)
+            if not sites:
+                del self.definitions[qualified]
+                parts = qualified.split('.')
+                for i in range(len(parts)):
+                    suffix = '.'.join(parts[i:])
+                    self.suffixes[suffix].discard(qualified)
+                    if not self.suffixes[suffix]:
+                        del self.suffixes[suffix]
+        return {qualified.rsplit('.', 1)[-1] for qualified, _ in entry.definitions}
+
+    def _index_references(self, file_path, entry, graph):
+        deps = graph.deps.get(file_path)
+        imports = deps.imports if deps is not None else {}
+        for tag in entry.table:
+            tag_type = tag['type']
+            if tag_type in IMPORT_TYPES:
+                target = imports.get(tag['name'], tag['name']) if tag_type == 'import_from_name' else tag['name']
+                entry.referenced.add(target.rsplit('.', 1)[-1])
+                qualified = self._resolve_target(target, graph)
+                if qualified:
+                    entry.references.append((qualified, self._site(file_path, tag, 'import')))
+            elif tag_type in CALL_TYPES:
+                entry.referenced.add(tag['name'])
+                qualified, ambiguous = self._resolve_call(tag, entry.module, imports, entry.top_level, graph)
+                if ambiguous:
+                    entry.unresolved.append((tag['name'], self._site(file_path, tag, 'call')))
+                elif qualified:
+                    entry.references.append((qualified, self._site(file_path, tag, 'call')))
+
+        for qualified, site in entry.references:
+            self.references.setdefault(qualified, {}).setdefault(file_path, []).append(site)
+        for name, site in entry.unresolved:
+            self.unresolved.setdefault(name, {}).setdefault(file_path, []).append(site)
+        for name in entry.referenced:
+            self.referencers.setdefault(name, set()).add(file_path)
+
+    def _unindex_references(self, file_path, entry):
+        for index, items in ((self.references, entry.references), (self.unresolved, entry.unresolved)):
+            for key in {key for key, _ in items}:
+                by_file = index[key]
+                by_file.pop(file_path, None)
+                if not by_file:
+                    del index[key]
+        for name in entry.referenced:
+            files = self.referencers[name]
+            files.discard(file_path)
+            if not files:
+                del self.referencers[name]
+        entry.references = []
+        entry.unresolved = []
+        entry.referenced = set()
+
+    def _resolve_call(self, tag, module, imports, top_level, graph):
+        """
+        Returns (qualified name or None, ambiguous). `receiver.name(...)` is
+        resolved through the receiver when it is an imported name (a module
+        alias like market_data, or a class), a class defined at the top of
+        this file, or self/cls inside a class; a receiver imported from
+        outside the repo resolves to None rather than to a same-named repo
+        method. Other calls fall back to a unique definition of the name, and
+        are ambiguous if there are several.
+        """
+        name = tag['name']
+        receiver = tag['value'] if tag['type'] == 'method_call' else None
+        if receiver:
+            head, _, rest = receiver.partition('.')
+            if head in imports:
+                return self._resolve_target('.'.join(p for p in (imports[head], rest, name) if p), graph), False
+            if head in top_level:
+                qualified = '.'.join(p for p in (module, receiver, name) if p)
+                if qualified in self.definitions:
+                    return qualified, False
+            if head in ('self', 'cls') and not rest:
+                scope = tag['scope']
+                classes = [i for i, (_, scope_type) in enumerate(scope) if scope_type == 'ClassDef']
+                if classes:
+                    qualified = '.'.join(p for p in [module] + scope_path(scope[:classes[-1] + 1]) + [name] if p)
+                    if qualified in self.definitions:
+                        return qualified, False
+        elif name in imports:
+            return self._resolve_target(imports[name], graph), False
+        elif name in top_level:
+            return (f"{module}.{name}" if module else name), False
+
+        candidates = self.suffixes.get(name, set())
+        if len(candidates) == 1:
+            return next(iter(candidates)), False
+        return None, bool(candidates)
+
+    def _resolve_target(self, target, graph):
+        """
+        Qualified definition name (or module name) an absolute import target
+        refers to, or None if it is outside the repo.
+        """
+        if target in self.definitions:
+            return target
+        candidates = self.suffixes.get(target)
+        if candidates and len(candidates) == 1:
+            return next(iter(candidates))
+        file_path = graph.find_module(target)
+        if file_path is not None:
+            return graph.deps[file_path].module
+        if '.' in target:
+            module_part, name = target.rsplit('.', 1)
+            file_path = graph.find_module(module_part)
+            if file_path is not None:
+                return f"{graph.deps[file_path].module}.{name}"
+        return None
+
+    def _site(self, file_path, tag, kind):
+        return (file_path, tag.start_line, kind, '.'.join(scope_path(tag['scope'])) or '<module>')
+
+    def lookup(self, name):
+        """
+        Qualified names matching `name`: an exact qualified name, or any
+        definition whose qualified name ends with `.name`.
+        """
+        name = name.strip().strip('`').rstrip('()')
+        if name in self.definitions:
+            return [name]
+        return sorted(self.suffixes.get(name, ()))
+
+    def definition_range(self, name, file_path=None):
+        """
+        (file_path, start_line, end_line) of the definition of `name`,
+        preferring one in `file_path`, or None.
+        """
+        sites = [site for qualified in self.lookup(name) for site in self.definitions[qualified] if site[2] is not None]
+        if file_path is not None:
+            sites = [site for site in sites if site[0] == file_path] or sites
+        if not sites:
+            return None
+        file_path, start_line, end_line, _ = sites[0]
+        return file_path, start_line, end_line
+
+    def describe(self, name, max_references=50):
+        matches = self.lookup(name)
+        if not matches:
+            return f"No definition found for '{name}'"
+
+        lines = []
+        for qualified in matches:
+            lines.append(f"{qualified}:")
+            for file_path, line, _, tag_type in self.definitions.get(qualified, []):
+                lines.append(f"  defined at {file_path}:{line} ({tag_type})")
+            references = sorted(site for sites in self.references.get(qualified, {}).values() for site in sites)
+            lines.append(f"  references ({len(references)}):")
+            for file_path, line, kind, scope in references[:max_references]:
+                lines.append(f"    {file_path}:{line} {kind} in {scope}")
+            if len(references) > max_references:
+                lines.append(f"    ... {len(references) - max_references} more")
+
+            short_name = qualified.rsplit('.', 1)[-1]
+            possible = sorted(site for sites in self.unresolved.get(short_name, {}).values() for site in sites)
+            if possible:
+                lines.append(f"  possible method calls of '{short_name}' (receiver type unknown, {len(possible)}):")
+                for file_path, line, kind, scope in possible[:max_references]:
+                    lines.append(f"    {file_path}:{line} in {scope}")
+        return '\n'.join(lines)
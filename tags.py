@@ -0,0 +1,144 @@
+import sys
+from array import array
+from itertools import accumulate
+
+
+class StaleIndexError(Exception):
+    """
+    A derived index (LexicalIndex, TagANN) was queried with tag positions
+    from a different code index generation than it was synced to.
+    """
+
+
+class FileTags:
+    """
+    Column storage for the tags of one file. The file source is kept once, and
+    each tag only stores interned name/type strings, a (start_line, end_line)
+    range into that source and an id into a table of immutable scope tuples.
+    Source text for a tag is only sliced out when Tag.lines is read.
+    """
+
+    __slots__ = ('file_path', 'source', 'line_offsets', 'names', 'types', 'starts', 'ends', 'scope_ids', 'values', 'scopes', '_scope_index')
+
+    def __init__(self, file_path, source):
+        self.file_path = sys.intern(file_path)
+        self.source = source
+        self.line_offsets = array('L', accumulate(map(len, source.splitlines(keepends=True)), initial=0))
+
+        self.names = []
+        self.types = []
+        self.starts = array('L')
+        self.ends = array('L')
+        self.scope_ids = array('L')
+        self.values = []
+        self.scopes = []
+        self._scope_index = {}
+
+    def __getstate__(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__ if slot != '_scope_index'}
+
+    def __setstate__(self, state):
+        for slot, value in state.items():
+            setattr(self, slot, value)
+        self._scope_index = {scope: i for i, scope in enumerate(self.scopes)}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i):
+        return Tag(self, i)
+
+    def __iter__(self):
+        return (Tag(self, i) for i in range(len(self.names)))
+
+    def add(self, name, tag_type, start_line, end_line, scope, value=None):
+        scope_id = self._scope_index.get(scope)
+        if scope_id is None:
+            scope_id = self._scope_index[scope] = len(self.scopes)
+            self.scopes.append(scope)
+
+        self.names.append(sys.intern(name))
+        self.types.append(sys.intern(tag_type))
+        self.starts.append(start_line)
+        self.ends.append(end_line)
+        self.scope_ids.append(scope_id)
+        self.values.append(value)
+
+    def text(self, start_line, end_line):
+        # lines are 1-based and inclusive, like ast lineno/end_lineno
+        offsets = self.line_offsets
+        last = len(offsets) - 1
+        return self.source[offsets[min(start_line - 1, last)]:offsets[min(end_line, last)]]
+
+    def moved(self, file_path):
+        moved = FileTags.__new__(FileTags)
+        moved.__setstate__(self.__getstate__())
+        moved.file_path = sys.intern(file_path)
+        return moved
+
+
+class Tag:
+    """
+    Lightweight view of one row of a FileTags table. Supports attribute access
+    and the old dict-style tag['name'] access.
+    """
+
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    @property
+    def file_path(self):
+        return self.table.file_path
+
+    @property
+    def name(self):
+        return self.table.names[self.index]
+
+    @property
+    def type(self):
+        return self.table.types[self.index]
+
+    @property
+    def start_line(self):
+        return self.table.starts[self.index]
+
+    @property
+    def end_line(self):
+        return self.table.ends[self.index]
+
+    @property
+    def scope(self):
+        return self.table.scopes[self.table.scope_ids[self.index]]
+
+    @property
+    def value(self):
+        return self.table.values[self.index]
+
+    @property
+    def lines(self):
+        return self.table.text(self.start_line, self.end_line)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def to_dict(self):
+        return {
+            'file_path': self.file_path,
+            'name': self.name,
+            'type': self.type,
+            'lines': self.lines,
+            'scope': self.scope,
+            'value': self.value,
+        }
+
+    def __repr__(self):
+        return f"Tag({self.file_path}:{self.start_line}-{self.end_line} {self.type} {self.name})"
@@ -0,0 +1,152 @@
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class Span:
+    __slots__ = ('name', 'category', 'start', 'duration', 'thread', 'parent', 'attrs')
+
+    def __init__(self, name, category, parent, attrs):
+        self.name = name
+        self.category = category
+        self.start = time.time()
+        self.duration = None
+        self.thread = threading.current_thread().name
+        self.parent = parent
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'category': self.category,
+            'start': self.start,
+            'duration': self.duration,
+            'thread': self.thread,
+            'parent': self.parent,
+            'attrs': self.attrs,
+        }
+
+
+class Tracer:
+    """
+    Collects timed spans for graph nodes, tool calls, LLM calls and index
+    operations. Spans nest per thread; the last max_spans are kept in memory
+    and can be exported as JSON lines or in Chrome trace format
+    (chrome://tracing, Perfetto).
+    """
+
+    def __init__(self, max_spans=10000):
+        self.spans = deque(maxlen=max_spans)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, category, **attrs):
+        stack = self._local.__dict__.setdefault('stack', [])
+        span = Span(name, category, stack[-1].name if stack else None, attrs)
+        stack.append(span)
+        start = time.perf_counter()
+        try:
+            yield span
+        except Exception as e:
+            span.set(error=str(e))
+            raise
+        finally:
+            span.duration = time.perf_counter() - start
+            stack.pop()
+            with self._lock:
+                self.spans.append(span)
+
+    def wrap(self, fn, name, category):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with self.span(name, category):
+                return fn(*args, **kwargs)
+        return wrapper
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.spans)
+
+    def clear(self):
+        with self._lock:
+            self.spans.clear()
+
+    def summary(self):
+        """
+        {'category:name': {'count', 'p50', 'p95', 'total'}} in seconds.
+        """
+        durations = {}
+        for span in self.snapshot():
+            durations.setdefault(f"{span.category}:{span.name}", []).append(span.duration)
+        summary = {}
+        for key, values in sorted(durations.items()):
+            values = np.asarray(values)
+            summary[key] = {
+                'count': len(values),
+                'p50': float(np.percentile(values, 50)),
+                'p95': float(np.percentile(values, 95)),
+                'total': float(values.sum()),
+            }
+        return summary
+
+    def report(self):
+        summary = self.summary()
+        if not summary:
+            return "No spans recorded yet"
+        width = max(len(key) for key in summary)
+        lines = [f"{'stage'.ljust(width)}  {'count':>5}  {'p50 ms':>9}  {'p95 ms':>9}  {'total s':>8}"]
+        for key, s in summary.items():
+            lines.append(f"{key.ljust(width)}  {s['count']:>5}  {s['p50'] * 1000:>9.1f}  {s['p95'] * 1000:>9.1f}  {s['total']:>8.2f}")
+        return '\n'.join(lines)
+
+    def write_jsonl(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w', encoding='UTF-8') as f:
+            for span in self.snapshot():
+                f.write(json.dumps(span.to_dict(), default=str) + '\n')
+
+    def write_chrome_trace(self, path):
+        threads = {}
+        events = []
+        for span in self.snapshot():
+            tid = threads.setdefault(span.thread, len(threads) + 1)
+            events.append({
+                'name': span.name,
+                'cat': span.category,
+                'ph': 'X',
+                'ts': span.start * 1e6,
+                'dur': span.duration * 1e6,
+                'pid': os.getpid(),
+                'tid': tid,
+                'args': {k: v if isinstance(v, (int, float, bool, type(None))) else str(v) for k, v in span.attrs.items()},
+            })
+        for thread, tid in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': thread}})
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w', encoding='UTF-8') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+tracer = Tracer()
+
+
+def token_usage(response, prompt_tokens=None):
+    """
+    (prompt, response) token counts of an LLM response, from the provider's
+    usage metadata when present.
+    """
+    usage = getattr(response, 'usage_metadata', None) or {}
+    if usage:
+        return usage.get('input_tokens', prompt_tokens), usage.get('output_tokens')
+    content = getattr(response, 'content', '')
+    return prompt_tokens, (len(str(content)) + 3) // 4
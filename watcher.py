@@ -0,0 +1,245 @@
+import ctypes
+import errno
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+# polling backs off so that scanning takes at most this share of the time
+POLL_SCAN_SHARE = 0.1
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify:
+    """
+    inotify watches on a set of directories, through libc (Linux only).
+    inotify isn't recursive, so every directory the scanner descends into
+    gets its own watch. read() returns the changed file paths, and whether
+    the tree has to be rescanned: a directory or .gitignore changed, or the
+    kernel queue overflowed.
+    """
+
+    def __init__(self, extensions):
+        self.extensions = tuple(extensions)
+        libc = ctypes.CDLL(None, use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = {}
+        self.dirs = set()
+
+    @classmethod
+    def available(cls):
+        if not sys.platform.startswith('linux'):
+            return False
+        try:
+            return hasattr(ctypes.CDLL(None), 'inotify_init1')
+        except OSError:
+            return False
+
+    def watch(self, dirs):
+        """
+        Adds a watch for each directory not watched yet. Raises OSError when
+        the per-user watch limit is reached.
+        """
+        for dir_path in dirs:
+            if dir_path in self.dirs:
+                continue
+            wd = self._add_watch(self.fd, os.fsencode(dir_path), WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err == errno.ENOSPC:
+                    raise OSError(err, f'inotify watch limit reached at {len(self.dirs)} directories')
+                # removed since the scan
+                continue
+            self.watches[wd] = dir_path
+            self.dirs.add(dir_path)
+
+    def read(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set(), False
+        data = b''
+        while True:
+            try:
+                chunk = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            if not chunk:
+                break
+            data += chunk
+
+        paths = set()
+        rescan = False
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                rescan = True
+            elif mask & IN_IGNORED:
+                self.dirs.discard(self.watches.pop(wd, None))
+            elif wd in self.watches:
+                if mask & IN_ISDIR or name == '.gitignore':
+                    rescan = True
+                elif name.endswith(self.extensions):
+                    paths.add(os.path.join(self.watches[wd], name))
+        return paths, rescan
+
+    def close(self):
+        os.close(self.fd)
+
+
+class IndexWatcher(threading.Thread):
+    """
+    Watches the tree under a CodeIndex in the background and keeps the index
+    hot. On Linux changed paths come from inotify; elsewhere (or past the
+    inotify watch limit) the tree is polled every `interval` seconds and
+    paths are found by comparing (mtime, size) against a stat cache, with
+    the interval stretched to keep scanning under POLL_SCAN_SHARE of the
+    time, up to max_interval. Changed paths are collected until no new
+    change has been seen for `debounce` seconds, and then handed to
+    CodeIndex.refresh(paths) so only those files are re-parsed. Callbacks in
+    on_change get the generation that refresh produced and its changes dict,
+    which is where embeddings and other derived state are updated.
+    """
+
+    def __init__(self, code_index, on_change=None, interval=0.5, debounce=1.0, max_interval=30.0, use_inotify=True):
+        super().__init__(name='index-watcher', daemon=True)
+        self.code_index = code_index
+        self.on_change = list(on_change or [])
+        self.interval = interval
+        self.debounce = debounce
+        self.max_interval = max(max_interval, interval)
+        self.use_inotify = use_inotify
+        self.backend = None
+
+        self.stat_cache = {path: (meta['mtime'], meta['size']) for path, meta in code_index.files.items()}
+        self.pending = set()
+        self.last_event = 0.0
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+
+    def scan(self):
+        current = self.code_index.scan()
+
+        with self._lock:
+            changed = {path for path, stat in current.items() if self.stat_cache.get(path) != stat}
+            changed.update(set(self.stat_cache) - set(current))
+            self.stat_cache = current
+            if changed:
+                self.pending.update(changed)
+                self.last_event = time.monotonic()
+        return changed
+
+    def _changed(self, paths):
+        with self._lock:
+            self.pending.update(paths)
+            self.last_event = time.monotonic()
+
+    def flush(self):
+        """
+        Applies pending changes now instead of waiting for the debounce
+        window. Only paths the watcher already saw as changed are
+        refreshed; the tree isn't walked again.
+        """
+        with self._lock:
+            paths = self.pending
+            self.pending = set()
+        if not paths:
+            return None
+
+        generation, changes = self.code_index.refresh(paths)
+        if any(changes.values()):
+            for callback in self.on_change:
+                try:
+                    callback(generation, changes)
+                except Exception as e:
+                    print(f'[LOG] index watcher callback failed: {e}')
+        return changes
+
+    def _flush_settled(self):
+        with self._lock:
+            settled = self.pending and time.monotonic() - self.last_event >= self.debounce
+        if settled:
+            self.flush()
+
+    def _start_inotify(self):
+        if not self.use_inotify or not Inotify.available():
+            return None
+        events = None
+        try:
+            events = Inotify(self.code_index.scanner.extensions)
+            # watch before scanning, so nothing between the two is missed
+            events.watch(self.code_index.scanner.dirs or [self.code_index.root_dir])
+            self.scan()
+            events.watch(self.code_index.scanner.dirs)
+            return events
+        except OSError as e:
+            print(f'[LOG] inotify unavailable, polling instead: {e}')
+            if events is not None:
+                events.close()
+            return None
+
+    def _run_inotify(self, events):
+        try:
+            while not self._stop_event.is_set():
+                paths, rescan = events.read(self.interval)
+                if rescan:
+                    self.scan()
+                    events.watch(self.code_index.scanner.dirs)
+                elif paths:
+                    self._changed(paths)
+                self._flush_settled()
+        finally:
+            events.close()
+
+    def _run_polling(self):
+        wait = self.interval
+        while not self._stop_event.wait(wait):
+            start = time.perf_counter()
+            self.scan()
+            elapsed = time.perf_counter() - start
+            wait = min(max(self.interval, elapsed * (1 - POLL_SCAN_SHARE) / POLL_SCAN_SHARE), self.max_interval)
+            self._flush_settled()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                events = self._start_inotify()
+                if events is not None:
+                    self.backend = 'inotify'
+                    self._run_inotify(events)
+                else:
+                    self.backend = 'poll'
+                    self._run_polling()
+            except OSError as e:
+                # e.g. the watch limit, hit by directories created later
+                print(f'[LOG] index watcher error, polling instead: {e}')
+                self.use_inotify = False
+            except Exception as e:
+                print(f'[LOG] index watcher error: {e}')
+                self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()